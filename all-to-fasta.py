@@ -2,170 +2,544 @@
 
 '''
 This script takes (and auto-detects) EMBL, FASTQ, GenBank, MEGA, SAM, and VCF files and converts them to a
-FASTA file. The user may also specify the number of nucleotide characters to be included on each line. 
+FASTA file. The user may also specify the number of nucleotide characters to be included on each line.
+Every converter reads its file as a stream of (header, sequence) records, and the records are written
+through one buffered file per extension, {input}.fna for nucleotide and {input}.faa for protein sequences.
+GenBank, EMBL and MEGA files may hold any number of records, which are read one at a time.
+With --threads, FASTQ and SAM files are cut into byte ranges that start at a record, which are
+converted by a pool of worker processes and written out in their original order.
+Inputs may be gzip or bgzip compressed, and --bgzip writes the FASTA files bgzip compressed.
+Several files or glob patterns are converted as a batch, one file per worker process at a time with
+--threads, and summarised with their format, records, bases and time.
+VCF genotypes are kept as a NumPy matrix of allele indexes, and every sample gets a record under its own name.
 '''
 
 import argparse
+import glob
+import gzip
+import os
+import queue
 import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from multiprocessing import Pool
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-f', '--fold', required=False, default = 70, type = int,
-    metavar = "<Line fold>", help = "The lenght of sequence per line; default=70")
-parser.add_argument('-i', '--input', required=True,
-    metavar = "<Input sequence file>", help = "Input sequence file in either EMBL, FASTQ, GenBank, MEGA, SAM, or VCF format")
-args = parser.parse_args()
-
-with open(args.input, 'r') as input_file:
-    first_line = input_file.readline()
-    second_line = input_file.readline()    
-    #identify possible file types
-    mega = bool(re.match("#MEGA", first_line))
-    if mega == True:
+import numpy as np
+
+MEGA = re.compile("#MEGA")
+FASTQ_HEADER = re.compile("^@")
+FASTQ_SEQUENCE = re.compile("^[A-Za-z]")
+EMBL = re.compile("^ID")
+SAM_HEADER = re.compile("^@")
+VCF = re.compile("^##")
+GENBANK = re.compile("^LOCUS")
+NUCLEOTIDES = re.compile("^[ATCGNatgcn]{4}")
+
+#VCF genotypes: bytes of a tab, of 0 and of a missing allele (.), and the variants parsed per batch
+TAB = ord('\t')
+ZERO = ord('0')
+MISSING = ord('.')
+ALLELE_INDEX = re.compile(b"[0-9]+")
+VCF_BATCH = 1 << 12
+
+GZIP_MAGIC = b'\x1f\x8b'
+#BGZF blocks: uncompressed size, gzip header with the BC extra field holding the block size - 1,
+#and the empty block that marks the end of a file
+BGZF_BLOCK = 0xff00
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+#whether a file is gzip (or bgzip) compressed
+def is_compressed(file):
+    with open(file, 'rb') as input_file:
+        return input_file.read(2) == GZIP_MAGIC
+
+#open a plain or gzip/bgzip compressed file for reading text
+def open_input(file):
+    if is_compressed(file):
+        return gzip.open(file, 'rt')
+    return open(file, 'r')
+
+#name of the output files of an input file, without the extension of a compressed file
+def output_prefix(file):
+    for extension in ('.gz', '.bgz'):
+        if file.endswith(extension) and is_compressed(file):
+            return file[:-len(extension)]
+    return file
+
+#bgzip (BGZF) compressed text output
+#text is cut into blocks that a background thread compresses and writes while the caller goes on,
+#zlib releases the GIL while it compresses so the two really run at the same time
+class BgzfWriter:
+    def __init__(self, path, level=6):
+        self.file = open(path, 'ab')
+        self.level = level
+        self.buffer = bytearray()
+        self.blocks = queue.Queue(maxsize = 64)
+        self.error = None
+        self.thread = threading.Thread(target = self._compress, daemon = True)
+        self.thread.start()
+
+    def write(self, text):
+        if self.error is not None:
+            raise self.error
+        self.buffer += text.encode()
+        while len(self.buffer) >= BGZF_BLOCK:
+            self.blocks.put(bytes(self.buffer[:BGZF_BLOCK]))
+            del self.buffer[:BGZF_BLOCK]
+
+    #compress and write blocks until None arrives, after an error the remaining blocks are dropped
+    def _compress(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+                data = compressor.compress(block) + compressor.flush()
+                self.file.write(BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(data) + 25))
+                self.file.write(data)
+                self.file.write(struct.pack('<II', zlib.crc32(block), len(block)))
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        if self.buffer:
+            self.blocks.put(bytes(self.buffer))
+            self.buffer.clear()
+        self.blocks.put(None)
+        self.thread.join()
+        try:
+            if self.error is not None:
+                raise self.error
+            self.file.write(BGZF_EOF)
+        finally:
+            self.file.close()
+
+#identify the file type from its first two lines, None when none matches
+def detect_type(first_line, second_line):
+    file_type = None
+    if MEGA.match(first_line):
         file_type = 'mega'
-    fastq = bool(re.match("^@", first_line) and re.match("^[A-Za-z]", second_line))
-    if fastq == True:
+    if FASTQ_HEADER.match(first_line) and FASTQ_SEQUENCE.match(second_line):
         file_type = 'fastq'
-    embl = bool(re.match("^ID", first_line))
-    if embl == True:
+    if EMBL.match(first_line):
         file_type = 'embl'
-    sam = bool(re.match("^@", first_line) and re.match("^@", second_line))
-    if sam == True:
+    if SAM_HEADER.match(first_line) and SAM_HEADER.match(second_line):
         file_type = 'sam'
-    vcf = bool(re.match("^##", first_line))
-    if vcf == True:
+    if VCF.match(first_line):
         file_type = 'vcf'
-    genbank = bool(re.match("^LOCUS", first_line))
-    if genbank == True:
+    if GENBANK.match(first_line):
         file_type = 'genbank'
-    print(f'File type detected: {file_type}')
-    
+    return file_type
+
 def wrap(string, length):
     return '\n'.join(string[i:i+length] for i in range(0, len(string), length) )
 
-def convert_mega(file):
-    sequence = ''
-    with open(file, 'r') as input_file:
-        for i in range(3):
-            next(input_file)
+#read a flat file one record at a time and yield parse(lines) for the lines of every record
+#a record starts at a line starting with start and runs up to the next one or to a line starting with
+#end, records that parse returns None for are skipped
+def flat_records(file, start, parse, end=None):
+    lines = None
+    with open_input(file) as input_file:
         for line in input_file:
-            if bool(re.match("^#", line)) == True:
-                header = '>' + str(line).rstrip('\n').lstrip('#')
-            else:
-                sequence = sequence + str(line.rstrip('\n'))
-        if bool(re.match("^[ATCGNatgcn]{4}", sequence)) == True:
-            extension = 'fna'
-        else:
-            extension = 'faa'
-    with open(f"{args.input}.{extension}",'a') as output:
-        output.write(f'{header}\n{wrap(sequence, args.fold)}')
+            if line.startswith(start):
+                if lines is not None:
+                    record = parse(lines)
+                    if record is not None:
+                        yield record
+                lines = [line]
+            elif end is not None and line.startswith(end):
+                if lines is not None:
+                    record = parse(lines)
+                    if record is not None:
+                        yield record
+                lines = None
+            elif lines is not None:
+                lines.append(line)
+    if lines is not None:
+        record = parse(lines)
+        if record is not None:
+            yield record
+
+#a MEGA record is a #name line followed by its sequence, the #MEGA line and its !commands are skipped
+def parse_mega(lines):
+    header = lines[0].rstrip('\n')[1:].strip()
+    if header.upper() == 'MEGA':
+        return None
+    return header, ''.join(''.join(line.split()) for line in lines[1:])
+
+def convert_mega(file):
+    return flat_records(file, '#', parse_mega)
+
+#a FASTQ record is four lines: @header, sequence, +, quality
+def fastq_records(lines):
+    lines = iter(lines)
+    for header, sequence, plus, quality in zip(lines, lines, lines, lines):
+        yield header.rstrip('\n')[1:], sequence.rstrip('\n')
 
 def convert_fastq(file):
-    with open(file, 'r') as input_file:
-        count = 0
-        for line in input_file:
-            count +=1
-            if bool(re.match("^@", line)) == True:
-                header = '>' + str(line).lstrip("@").rstrip('\n')
-            if count % 2 == 0 and count % 4 != 0:
-                sequence = line.rstrip('\n')
-                if bool(re.match("^[ATCGNatgcn]{4}", sequence)) == True:
-                    extension = 'fna'
-                else:
-                    extension = 'faa'
-                with open(f"{args.input}.{extension}",'a') as output:
-                    output.write(f'{header}\n{wrap(sequence, args.fold)}')
+    with open_input(file) as input_file:
+        yield from fastq_records(input_file)
+
+#a GenBank record runs from LOCUS to //, its header is the DEFINITION (or the LOCUS name when there is
+#none) and its sequence the lines after ORIGIN, without their positions
+def parse_genbank(lines):
+    definition = []
+    parts = []
+    keyword = None
+    for line in lines:
+        if not line.startswith(' '):
+            keyword = line[:12].strip()
+            if keyword == 'DEFINITION':
+                definition.append(line[12:].strip())
+        elif keyword == 'DEFINITION':
+            definition.append(line.strip())
+        elif keyword == 'ORIGIN':
+            parts.append(''.join(line.split()[1:]))
+    header = ' '.join(definition) if definition else lines[0].split()[1]
+    return header, ''.join(parts)
 
 def convert_genbank(file):
-    sequence = ''
-    with open(file, 'r') as input_file:
-        for line in input_file:
-            if bool(re.match("^DEFINITION", line)) == True:
-                header = '>' + line.lstrip("DEFINITION  ").rstrip("\n")
-            if bool(re.search("[0-9]{1,} [A-Za-z]{10}", line)) == True:
-                sequence = sequence + line.replace(' ','').lstrip('0123456789').rstrip('\n')
-            if bool(re.match("^[ATCGNatgcn]{4}", sequence)) == True:
-                extension = 'fna'
-            else:
-                extension = 'faa'
-    with open(f"{args.input}.{extension}",'a') as output:
-        output.write(f'{header}\n{wrap(sequence, args.fold)}')
-       
+    return flat_records(file, 'LOCUS', parse_genbank, '//')
+
+#an EMBL record runs from ID to //, its header is the ID line and its sequence the lines after SQ,
+#without the position at the end of each
+def parse_embl(lines):
+    header = lines[0][2:].strip()
+    parts = []
+    in_sequence = False
+    for line in lines[1:]:
+        if line.startswith('SQ'):
+            in_sequence = True
+        elif in_sequence:
+            parts.append(''.join(token for token in line.split() if not token.isdigit()))
+    return header, ''.join(parts)
 
 def convert_embl(file):
-    sequence = ''
-    with open(file,'r') as input_file:
-        for line in input_file:
-            if bool(re.match("^ID", line)) == True:
-                header = '>' + line.lstrip("ID   ").rstrip('\n')
-            if bool(re.search("\s{5}[A-Za-z]{10}", line)) == True:
-                sequence = sequence + line.replace(' ','').rstrip('0123456789\n ').lstrip('\s')
-            if bool(re.match("^[ATCGNatgcn]{4}", sequence)) == True:
-                extension = 'fna'
-            else:
-                extension = 'faa'
-    with open(f"{args.input}.{extension}",'a') as output:
-        output.write(f'{header}\n{wrap(sequence, args.fold)}')
+    return flat_records(file, 'ID', parse_embl, '//')
+
+#header lines start with @, reads without a stored sequence (*) are skipped
+def sam_records(lines):
+    for line in lines:
+        if line.startswith('@'):
+            continue
+        fields = line.split('\t', 10)
+        if fields[9] != '*':
+            yield fields[0], fields[9]
 
 def convert_sam(file):
-    with open(file,'r') as input_file:
-        for line in input_file:
-            if bool(re.match("^@", line)) == True:
-                next(input_file)
-            else:
-                header = '>' + line.split('\t')[0]
-                sequence = line.split('\t')[9]
-                if bool(re.match("^[ATCGNatgcn]{4}", sequence)) == True:
-                    extension = 'fna'
-                else:
-                    extension = 'faa'
-                with open(f"{args.input}.{extension}",'a') as output:
-                    output.write(f'\n{header}\n{wrap(sequence, args.fold)}')
-      
+    with open_input(file) as input_file:
+        yield from sam_records(input_file)
+
+#index of the first allele of the genotype of every sample on a VCF data line, -1 when it is missing
+#that index almost always is the single digit starting each sample column, which is read for all
+#samples at once from the bytes of the line, longer indexes are parsed one at a time
+def first_alleles(line, samples):
+    encoded = (line.rstrip('\n') + '\t').encode()
+    data = np.frombuffer(encoded, dtype=np.uint8)
+    starts = np.flatnonzero(data == TAB)[8:-1] + 1
+    if len(starts) != samples:
+        raise ValueError(f"VCF line with {len(starts)} samples instead of {samples}: {line[:50].rstrip()}")
+    first = data[starts]
+    digits = (first >= ZERO) & (first <= ZERO + 9)
+    if not (digits | (first == MISSING)).all():
+        raise ValueError(f"VCF genotype that does not start with an allele index: {line[:50].rstrip()}")
+    alleles = np.where(digits, first.astype(np.int16) - ZERO, -1).astype(np.int16)
+    following = data[starts + 1]
+    for i in np.flatnonzero(digits & (following >= ZERO) & (following <= ZERO + 9)):
+        alleles[i] = int(ALLELE_INDEX.match(encoded, starts[i]).group())
+    return alleles
+
+#sequences of one sample after another, gathered from all variant alleles packed into pool with the
+#offset and length of allele j of variant i at [i, j], and the allele index matrix of variants x samples
+def sample_sequences(pool, offsets, lengths, matrix):
+    variants = np.arange(matrix.shape[0])
+    for sample in range(matrix.shape[1]):
+        choice = matrix[:, sample]
+        chosen_lengths = lengths[variants, choice]
+        chosen_offsets = offsets[variants, choice]
+        #position of every base of the sequence in pool
+        moves = np.repeat(chosen_offsets - (np.cumsum(chosen_lengths) - chosen_lengths), chosen_lengths)
+        yield pool[moves + np.arange(len(moves))].tobytes().decode()
+
+#the first allele of every sample as a sequence, named after the sample, then the reference alleles
+#named after the last chromosome, a missing genotype gives as many Ns as the reference allele is long
+#genotypes are kept as a variants x samples matrix of 2 byte allele indexes, filled VCF_BATCH variants
+#at a time, and the sequences are gathered from it with NumPy one sample at a time
 def convert_vcf(file):
-    samples_dict = {}
-    ref_seq = ''
-    with open(file,'r') as input_file:
+    names = []
+    batches = []
+    rows = []
+    variants = []
+    ref_name = None
+    with open_input(file) as input_file:
         for line in input_file:
-            if bool(re.search("^#CHROM", line)) == True:
-                samples = line.rstrip('\n').split('\t')[9:]
-                for sample in samples:
-                    samples_dict['>' + str(sample)] = []
-            if bool(re.search("^#", line)) == False:
-                ref_name = line.rstrip('\n').split('\t')[0]
-                var = line.rstrip('\n').split('\t')[9:]
-                ref = line.rstrip('\n').split('\t')[3]
-                ref_seq += ref
-                alt = line.rstrip('\n').split('\t')[4].split(',')
-                for i in range(len(var)):
-                    type = var[i][0]
-                    sample = '>sample' + str(i+1)
-                    if int(type) == 0:
-                        samples_dict[sample].append(ref)
-                    else:
-                        samples_dict[sample].append(alt[int(type)-1])        
-    samples_dict['>' + str(ref_name)] = ref_seq
-    #print(samples_dict)
-    for samples in samples_dict:
-        header = samples
-        sequence = ' '.join(samples_dict[samples])
-        sequence = re.sub(' ', '', sequence)
-        if bool(re.match("^[ATCGNatgcn]{4}", sequence)) == True:
-            extension = 'fna'
+            if line.startswith('#'):
+                if line.startswith('#CHROM'):
+                    names = line.rstrip('\n').split('\t')[9:]
+                continue
+            fields = line.split('\t', 5)
+            ref_name = fields[0]
+            alleles = [fields[3]] + fields[4].split(',') + ['N'*len(fields[3])]
+            indexes = first_alleles(line, len(names))
+            if indexes.max(initial=0) >= len(alleles) - 1:
+                raise ValueError(f"VCF genotype with an allele that is not listed: {line[:50].rstrip()}")
+            indexes[indexes < 0] = len(alleles) - 1
+            rows.append(indexes)
+            variants.append(alleles)
+            if len(rows) == VCF_BATCH:
+                batches.append(np.vstack(rows))
+                rows = []
+    if rows:
+        batches.append(np.vstack(rows))
+    if not variants:
+        return
+    matrix = np.vstack(batches)
+    width = max(len(alleles) for alleles in variants)
+    offsets = np.zeros((len(variants), width), dtype=np.int64)
+    lengths = np.zeros((len(variants), width), dtype=np.int64)
+    position = 0
+    for i, alleles in enumerate(variants):
+        for j, allele in enumerate(alleles):
+            offsets[i, j] = position
+            lengths[i, j] = len(allele)
+            position += len(allele)
+    pool = np.frombuffer(''.join(allele for alleles in variants for allele in alleles).encode(), dtype=np.uint8)
+    for name, sequence in zip(names, sample_sequences(pool, offsets, lengths, matrix)):
+        yield name, sequence
+    yield ref_name, ''.join(alleles[0] for alleles in variants)
+
+CONVERTERS = {
+    'mega': convert_mega,
+    'fastq': convert_fastq,
+    'genbank': convert_genbank,
+    'embl': convert_embl,
+    'sam': convert_sam,
+    'vcf': convert_vcf,
+}
+
+#record parsers of the formats that can be split into byte ranges with --threads
+LINE_RECORDS = {
+    'fastq': fastq_records,
+    'sam': sam_records,
+}
+
+#a record as a piece of FASTA text: the extension of the file it goes to (fna when its sequence
+#starts with nucleotides, faa otherwise), the text and the number of records and bases in it
+def format_record(header, sequence, fold):
+    extension = 'fna' if NUCLEOTIDES.match(sequence) else 'faa'
+    return extension, f'>{header}\n{wrap(sequence, fold)}\n', 1, len(sequence)
+
+#offset of the first record starting at or after offset in a binary file handle
+#for SAM that is the next line, for FASTQ the next line starting with @ that has a + line two lines
+#further, as a quality line starting with @ is followed by a header and a sequence instead
+#an @ line without two lines after it can only be the quality line of the last record, so no
+#record starts at or after it
+def record_start(input_file, offset, file_type):
+    if offset == 0:
+        return 0
+    input_file.seek(offset - 1)
+    input_file.readline()
+    while True:
+        position = input_file.tell()
+        line = input_file.readline()
+        if not line or file_type == 'sam':
+            return position
+        if line.startswith(b'@'):
+            input_file.readline()
+            third = input_file.readline()
+            if not third:
+                input_file.seek(0, 2)
+                return input_file.tell()
+            if third.startswith(b'+'):
+                return position
+            input_file.seek(position)
+            input_file.readline()
+
+#split a FASTQ or SAM file into (start, stop) byte ranges of about chunk_size bytes that begin at records
+def byte_ranges(file, file_type, chunk_size):
+    size = os.path.getsize(file)
+    with open(file, 'rb') as input_file:
+        starts = sorted(set(record_start(input_file, offset, file_type) for offset in range(0, size, chunk_size)))
+    bounds = starts + [size]
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+#cut the lines of a compressed FASTQ or SAM file, which cannot be split into byte ranges, into
+#batches of about chunk_size bytes, FASTQ batches holding whole four line records
+def line_batches(file, file_type, chunk_size):
+    step = 4 if file_type == 'fastq' else 1
+    batch = []
+    size = 0
+    with open_input(file) as input_file:
+        for line in input_file:
+            batch.append(line)
+            size += len(line)
+            if size >= chunk_size and len(batch) % step == 0:
+                yield batch
+                batch = []
+                size = 0
+    if batch:
+        yield batch
+
+#convert the records in one byte range, as FASTA text per extension
+def convert_range(file, file_type, start, stop, fold):
+    with open(file, 'rb') as input_file:
+        input_file.seek(start)
+        lines = input_file.read(stop - start).decode().splitlines(True)
+    return convert_lines(lines, file_type, fold)
+
+#convert the records in a batch of lines, as one piece of FASTA text per extension
+def convert_lines(lines, file_type, fold):
+    parts = {}
+    counts = {}
+    for header, sequence in LINE_RECORDS[file_type](lines):
+        extension, text, records, bases = format_record(header, sequence, fold)
+        parts.setdefault(extension, []).append(text)
+        previous = counts.get(extension, (0, 0))
+        counts[extension] = (previous[0] + records, previous[1] + bases)
+    return [(extension, ''.join(texts), *counts[extension]) for extension, texts in parts.items()]
+
+#convert a FASTQ or SAM file in a pool of worker processes, which read byte ranges of a plain file
+#themselves and get batches of lines of a compressed one, keeping at most two chunks per process in
+#flight, and hand back their FASTA text in the order of the file
+def convert_parallel(file, file_type, fold, threads, chunk_size):
+    if is_compressed(file):
+        tasks = ((convert_lines, (lines, file_type, fold)) for lines in line_batches(file, file_type, chunk_size))
+    else:
+        tasks = ((convert_range, (file, file_type, start, stop, fold))
+            for start, stop in byte_ranges(file, file_type, chunk_size))
+    with Pool(threads) as pool:
+        pending = deque()
+        for function, arguments in tasks:
+            pending.append(pool.apply_async(function, arguments))
+            if len(pending) >= 2*threads:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+#write pieces of FASTA text to {prefix}.fna and {prefix}.faa through one buffered handle per
+#extension, or to {prefix}.fna.gz and {prefix}.faa.gz compressed with bgzip
+#returns the number of records and bases written
+def write_fasta(pieces, prefix, bgzip=False):
+    outputs = {}
+    total_records = 0
+    total_bases = 0
+    try:
+        for extension, text, records, bases in pieces:
+            total_records += records
+            total_bases += bases
+            if extension not in outputs:
+                if bgzip:
+                    outputs[extension] = BgzfWriter(f"{prefix}.{extension}.gz")
+                else:
+                    outputs[extension] = open(f"{prefix}.{extension}", 'a', buffering = 1 << 20)
+            outputs[extension].write(text)
+    finally:
+        for output in outputs.values():
+            output.close()
+    return total_records, total_bases
+
+#detect the format of a file from its first two lines, None when it is not one of the known ones
+def detect_file(file):
+    with open_input(file) as input_file:
+        first_line = input_file.readline()
+        second_line = input_file.readline()
+    return detect_type(first_line, second_line)
+
+#convert a file of a known format, returns the number of records and bases written
+def convert_file(file, file_type, fold, bgzip=False, threads=1, chunk_size=1 << 26):
+    if threads > 1 and file_type in LINE_RECORDS:
+        pieces = convert_parallel(file, file_type, fold, threads, chunk_size)
+    else:
+        pieces = (format_record(header, sequence, fold) for header, sequence in CONVERTERS[file_type](file))
+    return write_fasta(pieces, output_prefix(file), bgzip)
+
+#convert one file of a batch, returns its summary: file, format, records, bases, seconds and the error
+#that stopped it, if any, so one bad file does not stop the batch
+def batch_convert(task):
+    file, fold, bgzip = task
+    start = time.perf_counter()
+    file_type = None
+    try:
+        file_type = detect_file(file)
+        if file_type is None:
+            raise ValueError("could not detect the format")
+        records, bases = convert_file(file, file_type, fold, bgzip)
+    except Exception as error:
+        return file, file_type or 'unknown', 0, 0, time.perf_counter() - start, str(error) or type(error).__name__
+    return file, file_type, records, bases, time.perf_counter() - start, None
+
+#convert many files, each in one go, in a pool of worker processes, and print a summary line per file
+#in the order they were given, returns the number of files that failed
+def run_batch(files, fold, bgzip, threads):
+    tasks = [(file, fold, bgzip) for file in files]
+    print('file\tformat\trecords\tbases\tseconds')
+    failed = 0
+    if threads > 1:
+        pool = Pool(threads)
+        summaries = pool.imap(batch_convert, tasks)
+    else:
+        pool = None
+        summaries = map(batch_convert, tasks)
+    try:
+        for file, file_type, records, bases, seconds, error in summaries:
+            print(f'{file}\t{file_type}\t{records}\t{bases}\t{seconds:.3f}', flush = True)
+            if error is not None:
+                failed += 1
+                print(f'{file}: {error}', file = sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failed
+
+#input paths, with glob patterns expanded in sorted order
+def expand_inputs(inputs):
+    files = []
+    for pattern in inputs:
+        if glob.has_magic(pattern):
+            files.extend(sorted(glob.glob(pattern)))
         else:
-            extension = 'faa'
-        with open(f"{args.input}.{extension}",'a') as output:
-            output.write(f'\n{header}\n{wrap(sequence, args.fold)}')
-        #print(samples_dict[samples])
-
-if file_type == 'mega':
-    convert_mega(args.input)
-if file_type == 'fastq':
-    convert_fastq(args.input)
-if file_type == 'genbank':
-    convert_genbank(args.input)
-if file_type == 'embl':
-    convert_embl(args.input)
-if file_type == 'sam':
-    convert_sam(args.input)
-if file_type == 'vcf':
-    convert_vcf(args.input)
+            files.append(pattern)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--fold', required=False, default = 70, type = int,
+        metavar = "<Line fold>", help = "The lenght of sequence per line; default=70")
+    parser.add_argument('-i', '--input', required=True, nargs = '+',
+        metavar = "<Input sequence file>", help = "Input sequence file in either EMBL, FASTQ, GenBank, MEGA, SAM, or VCF format, "
+        "or several files or glob patterns to convert as a batch")
+    parser.add_argument('-t', '--threads', required=False, default = 1, type = int,
+        metavar = "<Number of processes>", help = "Number of worker processes for FASTQ and SAM files, or for the files of a batch; default=1")
+    parser.add_argument('-c', '--chunk_size', required=False, default = 1 << 26, type = int,
+        metavar = "<Chunk size>", help = "Number of bytes handed to a worker at a time; default=67108864")
+    parser.add_argument('-z', '--bgzip', action = "store_true",
+        help = "Write bgzip compressed FASTA files (.fna.gz, .faa.gz), compressed on a background thread")
+    args = parser.parse_args()
+    if args.chunk_size < 1:
+        parser.error("--chunk_size must be at least 1")
+
+    files = expand_inputs(args.input)
+    if not files:
+        parser.error(f"no files match {' '.join(args.input)}")
+    if len(files) > 1:
+        if run_batch(files, args.fold, args.bgzip, args.threads):
+            sys.exit(1)
+        sys.exit(0)
+
+    file_type = detect_file(files[0])
+    if file_type is None:
+        parser.error(f"could not detect the format of {files[0]}")
+    print(f'File type detected: {file_type}')
+    try:
+        convert_file(files[0], file_type, args.fold, args.bgzip, args.threads, args.chunk_size)
+    except ValueError as error:
+        parser.error(str(error))
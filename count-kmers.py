@@ -1,68 +1,355 @@
 #!/usr/bin/env python3
 
 import argparse
+import heapq
+import math
+import os
+import random
+import shutil
+import tempfile
+from array import array
+from collections import deque
+from multiprocessing import Pool
+
+from kmer_table import ENCODE, QUADS, encode, write_table
 
 '''
 This script counts k-mers in a given protein or nucleotide sequence file in FASTA format. User can 
-specify the k-mer lenght using the -k option. 
+specify the k-mer lenght using the -k option. Every record of a multi-FASTA file is counted on its own,
+so no k-mer spans two records, and the input can be split across several processes with the -t option.
+Count files written by separate runs can be combined with the -m option.
+With --binary, counts are written as a sorted, memory-mappable table of 2-bit packed k-mers that can be
+queried from Python with kmer_table.KmerTable.
+With --canonical, a k-mer and its reverse complement are counted together under the smaller of the two.
+The -x option caps the number of k-mers held in memory, larger tables are spilled to sorted runs on disk
+and merged at the end. The --approximate option only keeps k-mers seen at least --min_count times, using a
+count-min sketch whose counts are too high by at most epsilon * (total k-mers) with probability 1 - delta.
 '''
 
-#Define command line arguments
-parser = argparse.ArgumentParser()
-parser.add_argument('-f', '--file', required = False,
-    metavar = "Sequence file", help="FASTA nucleotide or protein file")
-parser.add_argument('-k', '--kmer_lenght', required = False,
-    metavar = "k-mer lenght", help="The lenght of k-mers you want to count")
-args = parser.parse_args()
-
-seq_lines = []
-lines = args.file.readlines()
-
-print("Configuring file...")
-#Get rid of first line
-for number, line in enumerate(lines):
-    if number not in [0]:
-        seq_lines.append(line)
-
-#format sequence into one big string
-seq_lines = ''.join(seq_lines)
-seq_lines = seq_lines.replace('\n', '')
-
-#initialize dictionary that will hold each k-mer and its count
-#initialize list that will store each k-mer in the sequence
-kmer_dict={}
-kmer_list = []
-
-start = 0
-end = int(kmer_length)
-
-print(f"Creating {kmer_length}-mer dictionary...")
-#get list of all kmers -> store in list
-for i in range(len(seq_lines)):
-    kmer = seq_lines[start:end]
-    if len(kmer) < int(kmer_length):
-        break
-    kmer_list.append(kmer)
-    start += 1
-    end += 1
-kmer_list.sort()
-
-#configure dictionary: add every k-mer to dictionary, set value to 0, and erase duplicate values
-#only adds unique k-mers because list is sorted (also I guess dictionaries only store unique values)
-for kmer in kmer_list:
-    kmer_dict[kmer] = 0
-
-print(f"Counting {kmer_length}-mers...")
-#count k-mers by comparing each dictionary element to the list elements
-for key in kmer_dict:
-    for kmer in kmer_list:
-        if key == kmer:
-            kmer_dict[kmer] += 1
-
-for key in kmer_dict:
-    print(f"{key}\t{kmer_dict[key]}")
-
-print("Writing results...")
-for key in kmer_dict:
-    with open(f'{kmer_length}-mers.txt', 'a') as kmer_counts:
-        kmer_counts.write(f"{key}\t{kmer_dict[key]}\n")
\ No newline at end of file
+COMPLEMENT = str.maketrans('ACGTRYKMBVDHacgtrykmbvdh', 'TGCAYRMKVBHDtgcayrmkvbhd')
+
+#Mersenne prime used by the count-min sketch hash functions
+PRIME = (1 << 61) - 1
+
+#count every k-mer of a sequence in a single pass
+#k-mers made only of A, C, G and T are kept as 2-bit packed integers updated with a rolling hash,
+#any other k-mer (protein alphabets, N or other IUPAC codes, soft-masked bases) is kept under its string
+#with canonical, the reverse complement is rolled along too and the smaller of the two is counted
+def count_kmers(sequence, k, counts=None, canonical=False):
+    if counts is None:
+        counts = {}
+    mask = (1 << (2*k)) - 1
+    shift = 2*(k-1)
+    code = 0
+    rc_code = 0
+    #number of packable bases at the end of the current window
+    run = 0
+    for i, base in enumerate(sequence):
+        value = ENCODE.get(base)
+        if value is None:
+            run = 0
+        else:
+            code = ((code << 2) | value) & mask
+            rc_code = (rc_code >> 2) | ((3 - value) << shift)
+            run += 1
+        if i + 1 < k:
+            continue
+        if run >= k:
+            key = rc_code if canonical and rc_code < code else code
+        else:
+            key = sequence[i+1-k:i+1]
+            if canonical:
+                key = min(key, reverse_complement(key))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+def reverse_complement(kmer):
+    return kmer.translate(COMPLEMENT)[::-1]
+
+#number of packed k-mers decoded at a time by decode_counts
+DECODE_BLOCK = 1 << 16
+
+#(k-mer, count) pairs of sorted packed k-mers that carry their count in the low shift bits
+#a block at a time is written out as bytes, turned into bases with one table lookup per byte
+#(the unused high bits of each first byte decode to As that are cut off) and cut into k-mers
+def decode_counts(packed, k, shift):
+    size = (k + 3) // 4
+    width = 4*size
+    mask = (1 << shift) - 1
+    for i in range(0, len(packed), DECODE_BLOCK):
+        block = packed[i:i + DECODE_BLOCK]
+        text = ''.join(map(QUADS.__getitem__, b''.join([(key >> shift).to_bytes(size, 'big') for key in block])))
+        yield from zip([text[j + width - k:j + width] for j in range(0, len(text), width)], [key & mask for key in block])
+
+#return (k-mer, count) pairs sorted by k-mer, packed and string keys can never collide
+#because string keys always hold at least one character outside of A, C, G and T
+#packed keys sort numerically in the same order as their strings, so they are sorted as integers,
+#with their count in the low bits so it needs no lookup afterwards, and only decoded once sorted,
+#then merged with the string keys, which are sorted on their own
+def sorted_counts(counts, k):
+    shift = max(counts.values(), default=0).bit_length()
+    packed = []
+    strings = []
+    for key, count in counts.items():
+        if isinstance(key, int):
+            packed.append((key << shift) | count)
+        else:
+            strings.append((key, count))
+    packed.sort()
+    strings.sort()
+    pairs = decode_counts(packed, k, shift)
+    return heapq.merge(pairs, strings) if strings else pairs
+
+#stream a FASTA file as batches of about chunk_size bases, one piece per record
+#long records are cut into pieces that overlap by k-1 bases, so every k-mer is seen exactly once
+def read_chunks(file, k, chunk_size):
+    batch = []
+    batch_size = 0
+    buffer = []
+    buffered = 0
+    with open(file, 'r') as seq_file:
+        for line in seq_file:
+            if line.startswith('>'):
+                if buffered:
+                    piece = ''.join(buffer)
+                    batch.append(piece)
+                    batch_size += len(piece)
+                buffer = []
+                buffered = 0
+                if batch_size >= chunk_size:
+                    yield batch
+                    batch = []
+                    batch_size = 0
+                continue
+            line = line.rstrip()
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= chunk_size:
+                piece = ''.join(buffer)
+                batch.append(piece)
+                yield batch
+                batch = []
+                batch_size = 0
+                overlap = piece[len(piece)-(k-1):] if k > 1 else ''
+                buffer = [overlap]
+                buffered = len(overlap)
+    if buffered:
+        batch.append(''.join(buffer))
+    if batch:
+        yield batch
+
+#worker: partial count table of one batch of sequence pieces
+def count_batch(batch, k, canonical):
+    counts = {}
+    for piece in batch:
+        count_kmers(piece, k, counts, canonical)
+    return counts
+
+#add a partial count table into the running total
+def merge_counts(counts, part):
+    for key, count in part.items():
+        counts[key] = counts.get(key, 0) + count
+    return counts
+
+#count-min sketch: depth rows of width counters, one hash function per row
+#an estimate is never below the true count and exceeds it by at most epsilon * total
+#with probability 1 - delta
+class CountMinSketch:
+    def __init__(self, epsilon, delta):
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        self.rows = [array('Q', bytes(8*self.width)) for i in range(self.depth)]
+        rng = random.Random(0)
+        self.hashes = [(rng.randrange(1, PRIME), rng.randrange(PRIME)) for i in range(self.depth)]
+        self.total = 0
+
+    def _columns(self, key):
+        x = (key if isinstance(key, int) else hash(key)) % PRIME
+        return [((a*x + b) % PRIME) % self.width for a, b in self.hashes]
+
+    def add(self, key, count):
+        self.total += count
+        estimate = None
+        for row, column in zip(self.rows, self._columns(key)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[column] for row, column in zip(self.rows, self._columns(key)))
+
+#running count table that merges partial tables from the workers
+#once it holds max_kmers k-mers it is written to disk as a sorted run and emptied,
+#items() then merges the runs with what is left in memory
+#with a sketch, every count goes into the sketch and the table only records which k-mers
+#have reached min_count, their counts are read back from the sketch at the end
+class CountTable:
+    def __init__(self, k, max_kmers=None, tmp_dir=None, sketch=None, min_count=1):
+        self.k = k
+        self.max_kmers = max_kmers
+        self.tmp_dir = tmp_dir
+        self.sketch = sketch
+        self.min_count = min_count
+        self.counts = {}
+        self.runs = []
+        self.run_dir = None
+
+    def add(self, part):
+        if self.sketch is not None:
+            for key, count in part.items():
+                estimate = self.sketch.add(key, count)
+                if estimate >= self.min_count and key not in self.counts:
+                    self.counts[key] = 0
+        elif not self.counts:
+            self.counts = part
+        else:
+            merge_counts(self.counts, part)
+        if self.max_kmers and len(self.counts) >= self.max_kmers:
+            self.spill()
+
+    def spill(self):
+        if self.run_dir is None:
+            self.run_dir = tempfile.mkdtemp(prefix='kmer-runs-', dir=self.tmp_dir)
+        run = os.path.join(self.run_dir, f'run{len(self.runs)}.txt')
+        with open(run, 'w') as run_file:
+            for key, count in sorted_counts(self.counts, self.k):
+                run_file.write(f"{key}\t{count}\n")
+        self.runs.append(run)
+        self.counts = {}
+
+    def items(self):
+        in_memory = sorted_counts(self.counts, self.k)
+        self.counts = {}
+        merged = merge_sorted([read_shard(run) for run in self.runs] + [in_memory])
+        try:
+            if self.sketch is None:
+                yield from merged
+            else:
+                #the sketch is keyed like count_kmers keys the table: by packed code, or by the
+                #string itself when it cannot be packed
+                for kmer, count in merged:
+                    code = encode(kmer)
+                    yield kmer, self.sketch.estimate(kmer if code is None else code)
+        finally:
+            if self.run_dir is not None:
+                shutil.rmtree(self.run_dir)
+
+#count a whole file into table, batches are handed to a pool of worker processes when threads > 1
+#at most two batches per worker are in flight so the file is never held in memory at once
+def count_file(file, k, threads, chunk_size, table, canonical=False):
+    if threads <= 1:
+        for batch in read_chunks(file, k, chunk_size):
+            table.add(count_batch(batch, k, canonical))
+        return table
+    with Pool(threads) as pool:
+        pending = deque()
+        for batch in read_chunks(file, k, chunk_size):
+            pending.append(pool.apply_async(count_batch, (batch, k, canonical)))
+            if len(pending) >= 2*threads:
+                table.add(pending.popleft().get())
+        while pending:
+            table.add(pending.popleft().get())
+    return table
+
+#read a saved <kmer>\t<count> file, which is sorted by k-mer
+def read_shard(file):
+    with open(file, 'r') as shard:
+        for line in shard:
+            kmer, count = line.rstrip('\n').split('\t')
+            yield kmer, int(count)
+
+#merge sorted (k-mer, count) streams in one pass, adding up the counts of shared k-mers
+def merge_sorted(streams):
+    current = None
+    total = 0
+    for kmer, count in heapq.merge(*streams):
+        if kmer != current:
+            if current is not None:
+                yield current, total
+            current = kmer
+            total = 0
+        total += count
+    if current is not None:
+        yield current, total
+
+#merge any number of sorted count files
+def merge_shards(files):
+    return merge_sorted([read_shard(file) for file in files])
+
+#print each count on its way to the output file
+def echo_counts(kmer_counts):
+    for key, count in kmer_counts:
+        print(f"{key}\t{count}")
+        yield key, count
+
+def main():
+    #Define command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', required = False,
+        metavar = "Sequence file", help="FASTA nucleotide or protein file")
+    parser.add_argument('-k', '--kmer_lenght', required = False, type = int,
+        metavar = "k-mer lenght", help="The lenght of k-mers you want to count")
+    parser.add_argument('-t', '--threads', required = False, type = int, default = 1,
+        metavar = "Number of processes", help="Number of worker processes used for counting; default=1")
+    parser.add_argument('-c', '--chunk_size', required = False, type = int, default = 1000000,
+        metavar = "Chunk size", help="Number of bases handed to a worker at a time; default=1000000")
+    parser.add_argument('-m', '--merge', required = False, nargs = '+',
+        metavar = "Count file", help="Merge count files from earlier runs instead of counting a FASTA file")
+    parser.add_argument('-o', '--output', required = False,
+        metavar = "Output file", help="Name of the output file; default=<k>-mers.txt or <k>-mers.bin")
+    parser.add_argument('-b', '--binary', action = "store_true",
+        help="Write a binary count table of nucleotide k-mers (k <= 32) instead of text")
+    parser.add_argument('-q', '--quiet', action = "store_true",
+        help="Do not echo the counts to standard output")
+    parser.add_argument('--canonical', action = "store_true",
+        help="Count each k-mer together with its reverse complement (nucleotide input only)")
+    parser.add_argument('-x', '--max_kmers', required = False, type = int,
+        metavar = "Table size", help="Number of k-mers held in memory before spilling sorted runs to disk")
+    parser.add_argument('--tmp_dir', required = False,
+        metavar = "Directory", help="Directory for spilled runs; default=system temporary directory")
+    parser.add_argument('-a', '--approximate', action = "store_true",
+        help="Only keep k-mers seen at least --min_count times, with counts estimated by a count-min sketch")
+    parser.add_argument('--min_count', required = False, type = int, default = 2,
+        metavar = "Count", help="Smallest count kept by --approximate; default=2")
+    parser.add_argument('--epsilon', required = False, type = float, default = 0.00001,
+        metavar = "Error", help="Sketch error as a fraction of all counted k-mers; default=0.00001")
+    parser.add_argument('--delta', required = False, type = float, default = 0.01,
+        metavar = "Probability", help="Probability that a sketch count exceeds the error bound; default=0.01")
+    args = parser.parse_args()
+    if args.chunk_size < 1:
+        parser.error("--chunk_size must be at least 1")
+    if args.binary and args.kmer_lenght is not None and not 0 < args.kmer_lenght <= 32:
+        parser.error("--binary only holds k-mers of length 1 to 32")
+
+    if args.merge:
+        kmer_counts = merge_shards(args.merge)
+        if args.kmer_lenght is None:
+            with open(args.merge[0], 'r') as shard:
+                args.kmer_lenght = len(shard.readline().split('\t')[0])
+    else:
+        sketch = CountMinSketch(args.epsilon, args.delta) if args.approximate else None
+        table = CountTable(args.kmer_lenght, args.max_kmers, args.tmp_dir, sketch, args.min_count)
+        print(f"Counting {args.kmer_lenght}-mers...")
+        count_file(args.file, args.kmer_lenght, args.threads, args.chunk_size, table, args.canonical)
+        if sketch is not None:
+            print(f"Counts are at most {args.epsilon*sketch.total:.0f} too high with probability {1-args.delta}")
+        kmer_counts = table.items()
+    kmer_length = args.kmer_lenght
+    extension = 'bin' if args.binary else 'txt'
+    output = args.output or f'{kmer_length}-mers.{extension}'
+
+    if not args.quiet:
+        kmer_counts = echo_counts(kmer_counts)
+    print("Writing results...")
+    if args.binary:
+        written, skipped = write_table(output, kmer_length, kmer_counts, args.canonical)
+        if skipped:
+            print(f"Skipped {skipped} k-mers with characters other than A, C, G and T")
+    else:
+        with open(output, 'w') as kmer_counts_file:
+            for key, count in kmer_counts:
+                kmer_counts_file.write(f"{key}\t{count}\n")
+
+if __name__ == '__main__':
+    main()
@@ -4,117 +4,327 @@
 This script uses BLAST to identify orthologous genes between two input files in FASTA format.
 Command line BLAST functions are wrapped for alignment, and the user may specify -p for a protein file
 or -n for a nucleotide file, which will tell the program to use BLASTp or BLASTn, respectively.
+Both databases are built at once and both search directions run at once, with the query files cut into
+chunks that are searched in parallel, within a budget of --cores cores shared out with -num_threads.
+Given -i with any number of files instead, every file is searched against every other: each database
+is built once and each direction searched once, in parallel and in separate scratch directories, and
+the reciprocal best hits of all pairs are written to one table and joined into ortholog groups.
+With --db_cache, databases are kept in a directory named by a hash of their FASTA file and type,
+reused by later runs, and the least recently used ones are removed when it grows past --db_cache_size.
 '''
 
 import argparse
+import hashlib
+import os
+import shutil
 import subprocess
-import shlex
-
-#Define command line arguments
-parser = argparse.ArgumentParser()
-parser.add_argument('-i1', '--file1', required = False,
-    metavar = "Sequence1", help="FASTA nucleotide or protein file")
-parser.add_argument('-i2', '--file2', required = False,
-    metavar = "Sequence2", help="FASTA nucleotide or protein file")
-parser.add_argument('-t', '--sequence_type', required = False,
-    metavar = "Sequence type", help="Either nucleotide(n) or protein(p)")
-parser.add_argument('-o', '--output_file', required = False,
-    metavar = "Output file name", help="The name of the output file")
-args = parser.parse_args()
-
-#determine which blast type to use
-dbtype = ''
-blast = ''
-if args.sequence_type == 'n':
-    dbtype = 'nucl'
-    blast = 'blastn'
-elif args.sequence_type == 'p':
-    dbtype = 'prot'
-    blast = 'blastp'
-
-
-#create blast database for each input file
-subprocess.call(shlex.split(f"makeblastdb -in {args.file1} -dbtype {dbtype} -out db1"))
-subprocess.call(shlex.split(f"makeblastdb -in {args.file2} -dbtype {dbtype} -out db2"))
-
-
-#blast query sequences
-subprocess.call(shlex.split(f"{blast} -query {args.file1} -db db2 -outfmt 6 -out 1v2.txt"))
-subprocess.call(shlex.split(f"{blast} -query {args.file2} -db db1 -outfmt 6 -out 2v1.txt"))
-
-#Remove blast database file: for some reason rm db1* db2* didn't work?
-#subprocess.check_output("rm db.*, shell=True") <- will get the job done
-subprocess.call(shlex.split(f"rm db1.nhr db1.nin db1.nsq db2.nhr db2.nin db2.nsq"))
-
-#open and read blast output files
-file1 = open('1v2.txt', 'r')
-file2 = open('2v1.txt', 'r')
-line1 = file1.readlines()
-line1.sort()
-line2 = file2.readlines()
-line2.sort()
-
-#get columns of interest and store in lists for blast1v2
-query1 = []
-evalues1 = []
-hit1 = []
-for column in line1:
-    e = float((column.split('\t')[10]))
-    evalues1.append(float(e))
-    q = column.split('\t')[0]
-    query1.append(q)
-    b = column.split('\t')[1]
-    hit1.append(b)
-
-#get columns of interest and store in lists for blast2v1
-query2 = []
-evalues2 = []
-hit2 = []
-for column in line2:
-    e = float((column.split('\t')[10]))
-    evalues2.append(float(e))
-    q = column.split('\t')[0]
-    query2.append(q)
-    b = column.split('\t')[1]
-    hit2.append(b)
-
-
-#find best hit, store in dictionary with structure dict = {'query sequence': 'target sequence'} for blast1v2
-best_dict1 = {}
-for i in range(len(query1)-1):
-    if query1[i] == query1[i+1] and evalues1[i] > evalues1[i+1]:
-        best_dict1[query1[i]] = str(hit1[i])
-    elif query1[i] == query1[i+1] and evalues1[i] < evalues1[i+1]:
-        best_dict1[query1[i]] = str(hit1[i+1])
-    elif query1[i] != query1[i+1]:
-        best_dict1[query1[i]] = str(hit1[i])
-
-#find best hit, store in dictionary with structure dict = {'query sequence': 'target sequence'} for blast2v1
-best_dict2 = {}
-for i in range(len(query2)-1):
-    if query2[i] == query2[i+1] and evalues2[i] > evalues2[i+1]:
-        best_dict2[query2[i]] = str(hit2[i])
-    elif query2[i] == query2[i+1] and evalues2[i] < evalues2[i+1]:
-        best_dict2[query2[i]] = str(hit2[i+1])
-    elif query2[i] != query2[i+1]:
-        best_dict2[query2[i]] = str(hit2[i])
-
-#iterate through best hits 1 and 2 dictionaries and write orthologs to outfile
-ortholog_count = 0
-for hit1 in best_dict1:
-    for hit2 in best_dict2:
-        if best_dict1[hit1] == hit2 and best_dict2[hit2] == hit1:
-            ortholog_count += 1
-            with open(f'{args.output_file}_find_ortholog.output', 'a') as orthologs:
-                orthologs.write(f'{hit1}\t{best_dict1[hit1]}\n')
-
-#make summary file
-with open(f'{args.output_file}_README.txt', 'a') as readme:
-    readme.write(f'Input 1 BLAST hits against input 2: {len(query1)}\n')
-    readme.write(f'\tHits after filtering for best hits only: {len(best_dict1)}\n')
-    readme.write(f'Input 2 BLAST hits against input 1: {len(query2)}\n')
-    readme.write(f'\tHits after filtering for best hits only: {len(best_dict2)}\n')
-    readme.write(f'Number of orthologous genes: {ortholog_count}\n')
-
-#delete initial blast output files
-subprocess.call(shlex.split(f"rm 1v2.txt 2v1.txt"))
\ No newline at end of file
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+#columns of BLAST tabular output (-outfmt 6)
+QUERY = 0
+SUBJECT = 1
+EVALUE = 10
+BITSCORE = 11
+
+#read BLAST tabular output one line at a time and keep the best hit of every query: the lowest
+#e-value, then the highest bitscore, then the first one listed
+#returns a dictionary of query -> target sequence, in the order queries first appear, and the number of hits
+def best_hits(file):
+    best = {}
+    hits = 0
+    with open(file, 'r') as blast_file:
+        for line in blast_file:
+            if not line.strip() or line.startswith('#'):
+                continue
+            columns = line.rstrip('\n').split('\t')
+            hits += 1
+            key = (float(columns[EVALUE]), -float(columns[BITSCORE]))
+            query = columns[QUERY]
+            if query not in best or key < best[query][0]:
+                best[query] = (key, columns[SUBJECT])
+    return {query: subject for query, (key, subject) in best.items()}, hits
+
+#pairs of sequences that are each other's best hit, in the order of best1
+def reciprocal_best_hits(best1, best2):
+    for query, subject in best1.items():
+        if best2.get(subject) == query:
+            yield query, subject
+
+#join pairs of sequences into groups, the connected components of the pairs
+#returns lists of sequences, in the order groups and their members first appear
+def ortholog_groups(pairs):
+    parent = {}
+    def root(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    for a, b in pairs:
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        parent[root(b)] = root(a)
+    groups = {}
+    for node in parent:
+        groups.setdefault(root(node), []).append(node)
+    return list(groups.values())
+
+#run a command, raising CalledProcessError when it fails
+def run(command):
+    subprocess.run(command, check = True)
+
+#cut a FASTA file into at most n files of about the same size in directory, each starting at a record,
+#the files are named after prefix, returns their paths
+def split_fasta(file, n, directory, prefix):
+    size = os.path.getsize(file)
+    paths = []
+    output = None
+    written = 0
+    with open(file, 'r') as fasta:
+        for line in fasta:
+            #piece k starts at the first record after k/n of the file
+            if line.startswith('>') and (output is None or written >= size*len(paths)/n):
+                if output is not None:
+                    output.close()
+                paths.append(os.path.join(directory, f'{prefix}.{len(paths)}.fasta'))
+                output = open(paths[-1], 'w')
+            if output is not None:
+                output.write(line)
+                written += len(line)
+    if output is not None:
+        output.close()
+    return paths
+
+#sha256 of the database type and a file's content, which names the file's database in the cache
+def database_key(file, dbtype):
+    digest = hashlib.sha256(dbtype.encode() + b'\0')
+    with open(file, 'rb') as fasta:
+        for block in iter(lambda: fasta.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+#path of the BLAST database of a file
+#without a cache_dir it is built in scratch under name, with one it is looked up in the cache by
+#content and type, and when missing built in a temporary directory there and renamed into place,
+#so every database in the cache is complete even with several runs building at once
+#a database that is used gets its directory's modification time set to now, for pruning
+def database(file, dbtype, makeblastdb, scratch, name, cache_dir=None):
+    if cache_dir is None:
+        path = os.path.join(scratch, name)
+        run([makeblastdb, '-in', file, '-dbtype', dbtype, '-out', path])
+        return path
+    directory = os.path.join(cache_dir, f'{database_key(file, dbtype)}-{dbtype}')
+    if not os.path.isdir(directory):
+        building = tempfile.mkdtemp(dir = cache_dir, prefix = '.building-')
+        try:
+            run([makeblastdb, '-in', file, '-dbtype', dbtype, '-out', os.path.join(building, 'db')])
+            os.rename(building, directory)
+        except OSError:
+            #another run put the same database in place first
+            if not os.path.isdir(directory):
+                raise
+        finally:
+            shutil.rmtree(building, ignore_errors = True)
+    os.utime(directory)
+    return os.path.join(directory, 'db')
+
+#remove the least recently used databases from the cache until it holds at most max_bytes,
+#never removing the database directories in keep
+def prune_cache(cache_dir, max_bytes, keep):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and not entry.name.startswith('.'):
+            size = sum(item.stat().st_size for item in os.scandir(entry.path) if item.is_file())
+            entries.append((entry.stat().st_mtime, size, entry.path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        shutil.rmtree(path, ignore_errors = True)
+        total -= size
+
+#build (or find in the cache) the databases of both files at once, then run both search directions at
+#once, each with its queries cut into chunks, all within a budget of cores
+#the searches run as concurrent BLAST processes, one per chunk and at most one per core, and share the
+#cores between them with -num_threads, their outputs are joined in order into output1 and output2
+#returns the paths of both databases
+def run_searches(file1, file2, dbtype, blast, makeblastdb, cores, chunks, output1, output2, scratch, cache_dir=None):
+    with ThreadPoolExecutor(max_workers = 2) as pool:
+        builds = [pool.submit(database, file, dbtype, makeblastdb, scratch, name, cache_dir)
+            for file, name in ((file1, 'db1'), (file2, 'db2'))]
+        db1, db2 = [build.result() for build in builds]
+    searches = []
+    parts = {}
+    for number, (query, db, output) in enumerate(((file1, db2, output1), (file2, db1, output2))):
+        queries = [query] if chunks <= 1 else split_fasta(query, chunks, scratch, f'query{number + 1}')
+        parts[output] = [os.path.join(scratch, f'{os.path.basename(output)}.{i}') for i in range(len(queries))]
+        searches += [(chunk, db, part) for chunk, part in zip(queries, parts[output])]
+    workers = max(1, min(len(searches), cores))
+    threads = max(1, cores // workers)
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        list(pool.map(run, [[blast, '-query', chunk, '-db', db, '-outfmt', '6', '-out', part,
+            '-num_threads', str(threads)] for chunk, db, part in searches]))
+    for output, output_parts in parts.items():
+        with open(output, 'w') as merged:
+            for part in output_parts:
+                #BLAST writes no file for a query chunk without hits in some versions
+                if os.path.exists(part):
+                    with open(part, 'r') as part_file:
+                        shutil.copyfileobj(part_file, merged)
+    return db1, db2
+
+#build the databases of all files and search every file against every other's database, up to cores
+#BLAST processes at a time, each job in its own directory under scratch
+#the searches of a database start as soon as it is built, while the other databases are still building
+#returns a dictionary of (i, j) -> BLAST output of file i searched against file j, and the database paths
+def run_all_searches(files, dbtype, blast, makeblastdb, cores, scratch, cache_dir=None):
+    workers = max(1, min(cores, len(files)*(len(files) - 1)))
+    threads = max(1, cores // workers)
+    databases = {}
+    outputs = {}
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        builds = {}
+        for j, file in enumerate(files):
+            directory = os.path.join(scratch, f'db{j}')
+            os.mkdir(directory)
+            builds[pool.submit(database, file, dbtype, makeblastdb, directory, 'db', cache_dir)] = j
+        searches = []
+        for build in as_completed(builds):
+            j = builds[build]
+            databases[j] = build.result()
+            for i, query in enumerate(files):
+                if i == j:
+                    continue
+                directory = os.path.join(scratch, f'{i}v{j}')
+                os.mkdir(directory)
+                outputs[i, j] = os.path.join(directory, 'hits.txt')
+                #BLAST writes no file for a query without hits in some versions
+                open(outputs[i, j], 'w').close()
+                searches.append(pool.submit(run, [blast, '-query', query, '-db', databases[j], '-outfmt', '6',
+                    '-out', outputs[i, j], '-num_threads', str(threads)]))
+        for search in searches:
+            search.result()
+    return outputs, [databases[j] for j in range(len(files))]
+
+if __name__ == '__main__':
+    #Define command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i1', '--file1', required = False,
+        metavar = "Sequence1", help="FASTA nucleotide or protein file")
+    parser.add_argument('-i2', '--file2', required = False,
+        metavar = "Sequence2", help="FASTA nucleotide or protein file")
+    parser.add_argument('-i', '--inputs', required = False, nargs = '+',
+        metavar = "Sequences", help="Two or more FASTA files to search all against all, instead of -i1 and -i2")
+    parser.add_argument('-t', '--sequence_type', required = False,
+        metavar = "Sequence type", help="Either nucleotide(n) or protein(p)")
+    parser.add_argument('-o', '--output_file', required = False,
+        metavar = "Output file name", help="The name of the output file")
+    parser.add_argument('-c', '--cores', required = False, type = int, default = os.cpu_count() or 1,
+        metavar = "Cores", help="Number of cores the BLAST runs may use at once; default=all of them")
+    parser.add_argument('-q', '--query_chunks', required = False, type = int, default = 0,
+        metavar = "Chunks", help="Number of pieces each query file of -i1 and -i2 is cut into and searched in parallel; default=one per 8 cores")
+    parser.add_argument('--blast', required = False,
+        metavar = "BLAST program", help="blastn or blastp executable to use; default=blastn or blastp on the PATH")
+    parser.add_argument('--makeblastdb', required = False, default = 'makeblastdb',
+        metavar = "makeblastdb program", help="makeblastdb executable to use; default=makeblastdb on the PATH")
+    parser.add_argument('--db_cache', required = False,
+        metavar = "Directory", help="Keep BLAST databases here, named by content, and reuse them across runs")
+    parser.add_argument('--db_cache_size', required = False, type = float, default = 10240,
+        metavar = "Megabytes", help="Size the database cache is pruned to, least recently used first; default=10240")
+    args = parser.parse_args()
+
+    #determine which blast type to use
+    dbtype = ''
+    blast = ''
+    if args.sequence_type == 'n':
+        dbtype = 'nucl'
+        blast = 'blastn'
+    elif args.sequence_type == 'p':
+        dbtype = 'prot'
+        blast = 'blastp'
+
+    if args.inputs:
+        files = args.inputs
+        names = [os.path.basename(file) for file in files]
+        if len(files) < 2:
+            parser.error("-i needs at least two files")
+        if len(set(names)) < len(names):
+            parser.error("the files given to -i need different names")
+    elif args.file1 and args.file2:
+        files = [args.file1, args.file2]
+    else:
+        parser.error("give either -i1 and -i2, or -i")
+
+    #create blast database for each input file and blast query sequences, in parallel, in a scratch
+    #directory of this run, which is removed with the blast output and uncached databases
+    chunks = args.query_chunks or max(1, args.cores // 8)
+    if args.db_cache:
+        os.makedirs(args.db_cache, exist_ok = True)
+    try:
+        with tempfile.TemporaryDirectory(dir = '.') as scratch:
+            if args.inputs:
+                outputs, databases = run_all_searches(files, dbtype, args.blast or blast, args.makeblastdb,
+                    args.cores, scratch, args.db_cache)
+            else:
+                outputs = {(0, 1): os.path.join(scratch, '1v2.txt'), (1, 0): os.path.join(scratch, '2v1.txt')}
+                databases = run_searches(args.file1, args.file2, dbtype, args.blast or blast, args.makeblastdb,
+                    args.cores, chunks, outputs[0, 1], outputs[1, 0], scratch, args.db_cache)
+
+            #stream blast output files, keeping the best hit of every query
+            best = {pair: best_hits(output) for pair, output in outputs.items()}
+    except subprocess.CalledProcessError as error:
+        sys.exit(f"{error.cmd[0]} failed with exit status {error.returncode}")
+    if args.db_cache:
+        prune_cache(args.db_cache, args.db_cache_size*(1 << 20),
+            {os.path.abspath(os.path.dirname(db)) for db in databases})
+
+    if not args.inputs:
+        best_dict1, hits1 = best[0, 1]
+        best_dict2, hits2 = best[1, 0]
+
+        #write pairs that are each other's best hit to outfile
+        ortholog_count = 0
+        with open(f'{args.output_file}_find_ortholog.output', 'a') as orthologs:
+            for hit1, hit2 in reciprocal_best_hits(best_dict1, best_dict2):
+                ortholog_count += 1
+                orthologs.write(f'{hit1}\t{hit2}\n')
+
+        #make summary file
+        with open(f'{args.output_file}_README.txt', 'a') as readme:
+            readme.write(f'Input 1 BLAST hits against input 2: {hits1}\n')
+            readme.write(f'\tHits after filtering for best hits only: {len(best_dict1)}\n')
+            readme.write(f'Input 2 BLAST hits against input 1: {hits2}\n')
+            readme.write(f'\tHits after filtering for best hits only: {len(best_dict2)}\n')
+            readme.write(f'Number of orthologous genes: {ortholog_count}\n')
+    else:
+        #write the pairs of every two files that are each other's best hit to one table, as
+        #file, sequence, file, sequence
+        pairs = []
+        counts = {}
+        with open(f'{args.output_file}_find_ortholog.output', 'a') as orthologs:
+            for i in range(len(files)):
+                for j in range(i + 1, len(files)):
+                    before = len(pairs)
+                    for hit1, hit2 in reciprocal_best_hits(best[i, j][0], best[j, i][0]):
+                        pairs.append(((names[i], hit1), (names[j], hit2)))
+                        orthologs.write(f'{names[i]}\t{hit1}\t{names[j]}\t{hit2}\n')
+                    counts[i, j] = len(pairs) - before
+
+        #join the pairs into ortholog groups, one line per sequence as group number, file, sequence
+        groups = ortholog_groups(pairs)
+        with open(f'{args.output_file}_ortholog_groups.output', 'a') as group_file:
+            for number, group in enumerate(groups, 1):
+                for name, sequence in group:
+                    group_file.write(f'{number}\t{name}\t{sequence}\n')
+
+        #make summary file
+        with open(f'{args.output_file}_README.txt', 'a') as readme:
+            for (i, j), (best_dict, hits) in sorted(best.items()):
+                readme.write(f'{names[i]} BLAST hits against {names[j]}: {hits}\n')
+                readme.write(f'\tHits after filtering for best hits only: {len(best_dict)}\n')
+            for (i, j), count in counts.items():
+                readme.write(f'Number of orthologous genes between {names[i]} and {names[j]}: {count}\n')
+            readme.write(f'Number of ortholog groups: {len(groups)}\n')
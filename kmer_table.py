@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+'''
+Binary k-mer count tables written by count-kmers.py with the --binary option. A table holds the
+2-bit packed codes of every counted k-mer (k <= 32) as a sorted array of unsigned 64-bit ints,
+followed by their counts as unsigned 32-bit ints, both in native byte order. The KmerTable class
+memory-maps a table so counts can be looked up in O(log n) without reading the file:
+
+    from kmer_table import KmerTable
+    with KmerTable('21-mers.bin') as table:
+        table['ACGTACGTACGTACGTACGTA']
+        for kmer, count in table.prefix('ACGT'):
+            ...
+'''
+
+import bisect
+import mmap
+import shutil
+import struct
+import tempfile
+from array import array
+
+#magic, format version, k, flags, number of k-mers
+HEADER = struct.Struct('<4sIIIQ')
+MAGIC = b'KMER'
+VERSION = 1
+CANONICAL = 1
+MAX_COUNT = (1 << 32) - 1
+#number of k-mers buffered before a block is written out
+BLOCK = 1 << 16
+
+#2-bit code of each nucleotide, A < C < G < T so packed k-mers sort the same way as their strings
+#count-kmers.py packs k-mers with the same code
+ENCODE = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+DECODE = 'ACGT'
+#the four bases of every byte of a packed k-mer, indexed by the byte
+QUADS = [''.join(DECODE[(byte >> shift) & 3] for shift in (6, 4, 2, 0)) for byte in range(256)]
+
+#2-bit packed code of a k-mer, None when it holds anything other than A, C, G and T
+def encode(kmer):
+    code = 0
+    for base in kmer:
+        value = ENCODE.get(base)
+        if value is None:
+            return None
+        code = (code << 2) | value
+    return code
+
+#string of a packed k-mer, four bases per table lookup
+#the unused high bits of the first byte are zero and decode to As that are cut off
+def decode(code, k):
+    size = (k + 3) // 4
+    return ''.join(map(QUADS.__getitem__, code.to_bytes(size, 'big')))[4*size - k:]
+
+def reverse_complement_code(code, k):
+    rc_code = 0
+    for i in range(k):
+        rc_code = (rc_code << 2) | (3 - (code & 3))
+        code >>= 2
+    return rc_code
+
+#write (k-mer, count) pairs, sorted by k-mer, as a binary table
+#k-mers that cannot be packed are skipped, returns the number of k-mers written and skipped
+def write_table(path, k, items, canonical=False):
+    if not 0 < k <= 32:
+        raise ValueError(f"binary tables hold k-mers of length 1 to 32, not {k}")
+    written = 0
+    skipped = 0
+    with open(path, 'wb') as table, tempfile.TemporaryFile() as count_file:
+        table.write(HEADER.pack(MAGIC, VERSION, k, CANONICAL if canonical else 0, 0))
+        codes = array('Q')
+        counts = array('I')
+        for kmer, count in items:
+            code = encode(kmer)
+            if code is None or len(kmer) != k:
+                skipped += 1
+                continue
+            codes.append(code)
+            counts.append(min(count, MAX_COUNT))
+            if len(codes) >= BLOCK:
+                written += len(codes)
+                codes.tofile(table)
+                counts.tofile(count_file)
+                codes = array('Q')
+                counts = array('I')
+        written += len(codes)
+        codes.tofile(table)
+        counts.tofile(count_file)
+        count_file.seek(0)
+        shutil.copyfileobj(count_file, table)
+        table.seek(0)
+        table.write(HEADER.pack(MAGIC, VERSION, k, CANONICAL if canonical else 0, written))
+    return written, skipped
+
+class KmerTable:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.k, flags, self.n = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a binary k-mer table")
+        self.canonical = bool(flags & CANONICAL)
+        view = memoryview(self._map)
+        start = HEADER.size
+        self.codes = view[start:start + 8*self.n].cast('Q')
+        self.counts = view[start + 8*self.n:start + 12*self.n].cast('I')
+
+    def close(self):
+        if getattr(self, 'codes', None) is not None:
+            self.codes.release()
+            self.counts.release()
+            self.codes = self.counts = None
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.n
+
+    #index of a k-mer in the table, or -1 when it was not counted
+    def _find(self, kmer):
+        code = encode(kmer)
+        if code is None or len(kmer) != self.k:
+            return -1
+        if self.canonical:
+            code = min(code, reverse_complement_code(code, self.k))
+        i = bisect.bisect_left(self.codes, code)
+        if i < self.n and self.codes[i] == code:
+            return i
+        return -1
+
+    def get(self, kmer, default=0):
+        i = self._find(kmer)
+        return self.counts[i] if i >= 0 else default
+
+    def __getitem__(self, kmer):
+        i = self._find(kmer)
+        if i < 0:
+            raise KeyError(kmer)
+        return self.counts[i]
+
+    def __contains__(self, kmer):
+        return self._find(kmer) >= 0
+
+    def __iter__(self):
+        for code in self.codes:
+            yield decode(code, self.k)
+
+    def items(self):
+        return self._slice(0, self.n)
+
+    def _slice(self, lo, hi):
+        for i in range(lo, hi):
+            yield decode(self.codes[i], self.k), self.counts[i]
+
+    #(k-mer, count) pairs with start <= k-mer < stop, either bound may be a shorter prefix
+    #or None for an open end
+    def range(self, start=None, stop=None):
+        lo = 0 if start is None else bisect.bisect_left(self.codes, self._bound(start))
+        hi = self.n if stop is None else bisect.bisect_left(self.codes, self._bound(stop))
+        return self._slice(lo, hi)
+
+    #(k-mer, count) pairs of every k-mer starting with prefix
+    def prefix(self, prefix):
+        lo = bisect.bisect_left(self.codes, self._bound(prefix))
+        hi = bisect.bisect_left(self.codes, self._bound(prefix, 'T'*(self.k - len(prefix))) + 1)
+        return self._slice(lo, hi)
+
+    #smallest code at or after a (possibly partial) k-mer, padded with fill
+    def _bound(self, kmer, fill=None):
+        if fill is None:
+            fill = 'A'*(self.k - len(kmer))
+        code = encode(kmer + fill)
+        if code is None or len(kmer) > self.k:
+            raise ValueError(f"{kmer} is not a k-mer prefix of A, C, G and T")
+        return code
@@ -3,128 +3,333 @@
 '''
 This script implements the Needleman-Wunsch alogrithm for sequence alignment. 
 This was more for practice than anything.
+The scoring matrix is filled one row at a time with NumPy, and the traceback is kept as a
+matrix of one-byte direction codes. With --linear-space, Hirschberg's divide and conquer is used
+instead, which finds an optimal alignment while only keeping a few rows of the matrix in memory.
+--score-only reports the score alone from two rows of the matrix. --band only fills the cells within
+a given distance of the diagonal, and doubles that distance until the banded score is provably optimal.
+With --batch, both files may hold many sequences, every pair is aligned across a pool of worker
+processes and the scores, coordinates and identities are written as a table.
 '''
 
+import argparse
 import sys
+from multiprocessing import Pool
 
-seq1 = sys.argv[1]
-seq2 = sys.argv[2]
+import numpy as np
 
 #initialize penalties and rewards
 gap = -1
 mis = -1
 match = 1
-#read each sequence file, store in separate lists
+
+#traceback direction codes
+DIAGONAL = 1
+UP = 2
+LEFT = 3
+
+#score of cells outside of the band
+NEG = -(1 << 40)
+
+#subproblems with at most this many cells are aligned with a full traceback matrix in linear-space mode
+BASE_CELLS = 1 << 16
 
 #open file, read second line
-seq1 = open(f'{seq1}', 'r')
-seq1 = seq1.readlines()
-seq = seq1[1].rstrip()
-
-#initialize list to store sequence and add every base to that list
-sequence1 = []
-for chr in seq:
-    sequence1.append(chr)
-
-#do the same as above for second sequence
-seq2 = open(f'{seq2}', 'r')
-seq2 = seq2.readlines()
-seq = seq2[1].rstrip()
-sequence2 = []
-for chr in seq:
-    sequence2.append(chr)
-
-#set up scoring matrix,
-#make first row in matrix and fill with gap penalties, 
-# fill start of every row with gap penalty
-matrix = []
-for i in range(len(sequence2)+1):
-    matrix.append([])
-for i in range(len(sequence1)+1):
-    matrix[0].append(gap*i)
-x = 1
-while x < len(matrix):
-    matrix[x].append(x*gap)
-    x+=1
-
-#set up traceback matrix same as before
-traceback = []
-for i in range(len(sequence2)+1):
-    traceback.append([])
-for i in range(len(sequence1)+1):
-    traceback[0].append(gap*i)
-x = 1
-while x < len(traceback):
-    traceback[x].append(x*gap)
-    x+=1
+def read_sequence(file):
+    with open(file, 'r') as seq_file:
+        return seq_file.readlines()[1].rstrip()
+
+#score of every base of sequence1 against each distinct base of sequence2
+def substitution_rows(sequence1, sequence2):
+    codes1 = np.frombuffer(sequence1.encode(), dtype=np.uint8)
+    rows = {}
+    for base in set(sequence2):
+        rows[base] = np.where(codes1 == ord(base), match, mis).astype(np.int64)
+    return rows
+
+#compute one row of the scoring matrix from the previous one
+#diagonal and up moves only depend on the previous row, and the chain of left moves is a
+#running maximum, H[j] = gap*j + max over k <= j of (best[k] - gap*k)
+def next_row(previous, scores, first, steps):
+    diagonal = previous[:-1] + scores
+    up = previous[1:] + gap
+    best = np.empty(len(previous), dtype=np.int64)
+    best[0] = first
+    np.maximum(diagonal, up, out=best[1:])
+    current = np.maximum.accumulate(best - steps) + steps
+    return current, diagonal, up
 
 #matrix filling
-for i in range(len(sequence2)):
-    for j in range(len(sequence1)):
-        diagonal = matrix[i][j]
-        left = matrix[i+1][j] + gap
-        up = matrix[i][j+1] + gap
-        #compare adjacent values
-        #see if diagonal is hit or miss
-        if sequence2[i] == sequence1[j]:
-            diagonal = diagonal + match
-        elif sequence2[i] != sequence1[j]:
-            diagonal = diagonal + mis
-        #compare scores, add highest to matrix
-        if diagonal >= up and diagonal >= left:
-            matrix[i+1].append(diagonal)
-            traceback[i+1].append('d')
-        elif up >= left and up > diagonal:
-            matrix[i+1].append(up)
-            traceback[i+1].append('u')
-        elif left > up:
-            matrix[i+1].append(left)
-            traceback[i+1].append('l')
+def fill(sequence1, sequence2):
+    n = len(sequence2)
+    m = len(sequence1)
+    rows = substitution_rows(sequence1, sequence2)
+    steps = gap*np.arange(m+1, dtype=np.int64)
+    traceback = np.empty((n+1, m+1), dtype=np.uint8)
+    traceback[0, :] = LEFT
+    traceback[:, 0] = UP
+    traceback[0, 0] = 0
+    previous = steps.copy()
+    for i in range(n):
+        current, diagonal, up = next_row(previous, rows[sequence2[i]], (i+1)*gap, steps)
+        left = current[:-1] + gap
+        #compare scores, the diagonal wins ties, then up
+        traceback[i+1, 1:] = np.where((diagonal >= up) & (diagonal >= left), DIAGONAL,
+            np.where(up >= left, UP, LEFT))
+        previous = current
+    return traceback, int(previous[-1])
+
+#last row of the scoring matrix, without keeping a traceback
+def last_row(sequence1, sequence2):
+    rows = substitution_rows(sequence1, sequence2)
+    steps = gap*np.arange(len(sequence1)+1, dtype=np.int64)
+    previous = steps.copy()
+    for i in range(len(sequence2)):
+        previous = next_row(previous, rows[sequence2[i]], (i+1)*gap, steps)[0]
+    return previous
+
+#Hirschberg's algorithm: split sequence2 in half, find the column where an optimal path crosses
+#the middle row from the last rows of the top half and of the reversed bottom half, then align
+#both quarters on their own, appending the alignment columns to the three lines
+def hirschberg(sequence1, sequence2, lines):
+    if len(sequence2) <= 1 or len(sequence1) == 0 or len(sequence1)*len(sequence2) <= BASE_CELLS:
+        traceback = fill(sequence1, sequence2)[0]
+        for line, part in zip(lines, trace(traceback, sequence1, sequence2)):
+            line.append(part)
+        return
+    middle = len(sequence2) // 2
+    top = last_row(sequence1, sequence2[:middle])
+    bottom = last_row(sequence1[::-1], sequence2[middle:][::-1])[::-1]
+    split = int(np.argmax(top + bottom))
+    hirschberg(sequence1[:split], sequence2[:middle], lines)
+    hirschberg(sequence1[split:], sequence2[middle:], lines)
+
+def align_linear_space(sequence1, sequence2):
+    lines = ([], [], [])
+    hirschberg(sequence1, sequence2, lines)
+    return tuple(''.join(line) for line in lines)
+
+#banded matrix filling, only cells (i, j) with low <= j - i <= high are computed
+#row i of the band holds cells j = i + low + k for k in 0..width-1, so the diagonal move stays in
+#column k, the up move comes from column k+1 of the previous row and the left move from column k-1
+def banded_fill(sequence1, sequence2, low, high, keep_traceback=True):
+    n = len(sequence2)
+    m = len(sequence1)
+    width = high - low + 1
+    #pad sequence1 with a zero byte so cells outside of the matrix can be looked up too
+    codes1 = np.frombuffer(sequence1.encode() + b'\0', dtype=np.uint8)
+    ks = np.arange(width, dtype=np.int64)
+    steps = gap*ks
+    traceback = np.zeros((n+1, width), dtype=np.uint8) if keep_traceback else None
+    j = low + ks
+    previous = np.where((j >= 0) & (j <= m), gap*j, NEG)
+    if keep_traceback:
+        traceback[0] = LEFT
+    for i in range(1, n+1):
+        j = i + low + ks
+        valid = (j >= 0) & (j <= m)
+        scores = np.where(codes1[np.clip(j-1, 0, m)] == ord(sequence2[i-1]), match, mis)
+        diagonal = np.where(j >= 1, previous + scores, NEG)
+        up = np.full(width, NEG, dtype=np.int64)
+        up[:-1] = previous[1:] + gap
+        best = np.where(valid, np.maximum(diagonal, up), NEG)
+        current = np.where(valid, np.maximum.accumulate(best - steps) + steps, NEG)
+        if keep_traceback:
+            left = np.empty(width, dtype=np.int64)
+            left[0] = NEG
+            left[1:] = current[:-1] + gap
+            traceback[i] = np.where((diagonal >= up) & (diagonal >= left), DIAGONAL,
+                np.where(up >= left, UP, LEFT))
+        previous = current
+    return traceback, int(previous[m-n-low])
+
+#any path that leaves a band of half-width w needs at least |m - n| + 2*(w+1) gaps, so no such
+#path can score more than an ungapped alignment of the remaining bases would
+def band_is_optimal(score, n, m, w):
+    gaps = abs(m-n) + 2*(w+1)
+    if gaps > n + m:
+        return True
+    return 2*score >= match*(n + m - gaps) + 2*gap*gaps
+
+#banded alignment, doubling the band until its score cannot be beaten by a path outside of it
+def align_banded(sequence1, sequence2, w, keep_traceback=True):
+    n = len(sequence2)
+    m = len(sequence1)
+    while True:
+        low = max(min(0, m-n) - w, -n)
+        high = min(max(0, m-n) + w, m)
+        traceback, score = banded_fill(sequence1, sequence2, low, high, keep_traceback)
+        if (low == -n and high == m) or band_is_optimal(score, n, m, w):
+            return traceback, score, low
+        w = max(2*w, 1)
+
+#score an alignment from its three lines
+def alignment_score(line1, line2, line3):
+    score = 0
+    for marker in line2:
+        if marker == '|':
+            score += match
+        elif marker == '*':
+            score += mis
+        else:
+            score += gap
+    return score
 
 #backtracking
-#get length of longest sequence for iteration number
-if len(sequence1) > len(sequence2):
-    length = len(sequence1)
-elif len(sequence2) > len(sequence1):
-    length = len(sequence2)
-
-#define lists that will hold alignment information
-line1 = []
-line2 = []
-line3 = []
-
-#loop through traceback matrix and find path of best alignment, 
+#loop through traceback matrix from the last cell to the first and find path of best alignment,
 #add bases and gap/mismatch information to lists
-x=-1
-y=-1
-for i in range(length):
-    target = traceback[x][y]
-    if target == 'd':
-        line1.append(sequence1[y])
-        if sequence1[y] == sequence2[x]:
-            line2.append('|')
+#a banded traceback matrix is indexed by (i, j - i - low)
+def trace(traceback, sequence1, sequence2, low=None):
+    line1 = []
+    line2 = []
+    line3 = []
+    x = len(sequence2)
+    y = len(sequence1)
+    while x > 0 or y > 0:
+        target = traceback[x, y if low is None else y - x - low]
+        if target == DIAGONAL:
+            line1.append(sequence1[y-1])
+            if sequence1[y-1] == sequence2[x-1]:
+                line2.append('|')
+            else:
+                line2.append('*')
+            line3.append(sequence2[x-1])
+            x -= 1
+            y -= 1
+        elif target == LEFT:
+            line1.append(sequence1[y-1])
+            line2.append(' ')
+            line3.append('-')
+            y -= 1
         else:
-            line2.append('*')
-        line3.append(sequence2[x])
-        x-=1
-        y-=1
-    elif target == 'l':
-        line1.append(sequence1[y])
-        line2.append(' ')
-        line3.append('-')
-        x = x
-        y -= 1
-    elif target == 'u':
-        line1.append('-')
-        line2.append(' ')
-        line3.append(sequence2[x])
-        x -= 1
-        y = y
-
-
-#print results
-str = ""
-print(str.join(line1[::-1]))
-print(str.join(line2[::-1]))
-print(str.join(line3[::-1]))
-print(f'Alignment Score: {matrix[-1][-1]}')
+            line1.append('-')
+            line2.append(' ')
+            line3.append(sequence2[x-1])
+            x -= 1
+    return ''.join(line1[::-1]), ''.join(line2[::-1]), ''.join(line3[::-1])
+
+#align two sequences with the chosen mode, lines is None when only the score is wanted
+def align_pair(sequence1, sequence2, band=None, linear_space=False, score_only=False):
+    if score_only and band is not None:
+        return None, align_banded(sequence1, sequence2, band, keep_traceback=False)[1]
+    if score_only:
+        return None, int(last_row(sequence1, sequence2)[-1])
+    if band is not None:
+        traceback, score, low = align_banded(sequence1, sequence2, band)
+        return trace(traceback, sequence1, sequence2, low), score
+    if linear_space:
+        lines = align_linear_space(sequence1, sequence2)
+        return lines, alignment_score(*lines)
+    traceback, score = fill(sequence1, sequence2)
+    return trace(traceback, sequence1, sequence2), score
+
+#read every record of a multi-FASTA file as (name, sequence) pairs
+def read_fasta(file):
+    records = []
+    name = None
+    parts = []
+    with open(file, 'r') as seq_file:
+        for line in seq_file:
+            line = line.rstrip()
+            if line.startswith('>'):
+                if name is not None:
+                    records.append((name, ''.join(parts)))
+                name = line[1:].split()[0] if line[1:].split() else ''
+                parts = []
+            elif line:
+                parts.append(line)
+    if name is not None:
+        records.append((name, ''.join(parts)))
+    return records
+
+#sequences and alignment options of a batch run, set once in every worker process
+batch = {}
+
+def init_batch(queries, targets, options):
+    batch['queries'] = queries
+    batch['targets'] = targets
+    batch['options'] = options
+
+#align the query/target pairs numbered start to stop-1 and return their TSV lines
+def batch_rows(bounds):
+    start, stop = bounds
+    queries = batch['queries']
+    targets = batch['targets']
+    rows = []
+    for index in range(start, stop):
+        query_name, query = queries[index // len(targets)]
+        target_name, target = targets[index % len(targets)]
+        rows.append(f"{query_name}\t{target_name}\t{pair_row(query, target, batch['options'])}\n")
+    return ''.join(rows)
+
+#align every query against every target, handing chunks of pairs to a pool of worker processes,
+#and stream the results to output in a fixed order
+def run_batch(query_file, target_file, output, threads, chunk_size, options):
+    queries = read_fasta(query_file)
+    targets = read_fasta(target_file)
+    total = len(queries)*len(targets)
+    chunks = [(start, min(start + chunk_size, total)) for start in range(0, total, chunk_size)]
+    output.write('query\ttarget\tscore\tquery_start\tquery_end\ttarget_start\ttarget_end\tidentity\n')
+    if threads <= 1:
+        init_batch(queries, targets, options)
+        for chunk in chunks:
+            output.write(batch_rows(chunk))
+        return
+    with Pool(threads, initializer=init_batch, initargs=(queries, targets, options)) as pool:
+        for rows in pool.imap(batch_rows, chunks):
+            output.write(rows)
+
+#percent of alignment columns that are matches
+def identity(lines):
+    if not lines[1]:
+        return 0.0
+    return 100*lines[1].count('|')/len(lines[1])
+
+#score, coordinates and identity of a global alignment, the coordinates always span both sequences
+def pair_row(query, target, options):
+    lines, score = align_pair(query, target, **options)
+    if lines is None:
+        return f"{score}\t1\t{len(query)}\t1\t{len(target)}\tNA"
+    return f"{score}\t1\t{len(query)}\t1\t{len(target)}\t{identity(lines):.2f}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sequence1', help = "FASTA file with the first sequence on its second line, or the queries with --batch")
+    parser.add_argument('sequence2', help = "FASTA file with the second sequence on its second line, or the targets with --batch")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--linear-space', action = "store_true",
+        help = "Use Hirschberg's algorithm, memory grows with the sequence lengths instead of their product")
+    mode.add_argument('--band', type = int, metavar = "<Width>",
+        help = "Only fill cells within this distance of the diagonal, widened until the score is optimal")
+    parser.add_argument('--score-only', action = "store_true",
+        help = "Only report the alignment score")
+    parser.add_argument('--batch', action = "store_true",
+        help = "Treat both files as multi-FASTA and align every sequence of the first against every sequence of the second")
+    parser.add_argument('-o', '--output', metavar = "<output_file_name>",
+        help = "TSV file for --batch results; default=standard output")
+    parser.add_argument('-t', '--threads', type = int, default = 1, metavar = "<Number of processes>",
+        help = "Number of worker processes for --batch; default=1")
+    parser.add_argument('--chunk-size', type = int, default = 64, metavar = "<Pairs>",
+        help = "Number of pairs handed to a worker at a time in --batch; default=64")
+    args = parser.parse_args()
+    if args.band is not None and args.band < 0:
+        parser.error("--band must be at least 0")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    options = {'band': args.band, 'linear_space': args.linear_space, 'score_only': args.score_only}
+
+    if args.batch:
+        output = open(args.output, 'w') if args.output else sys.stdout
+        run_batch(args.sequence1, args.sequence2, output, args.threads, args.chunk_size, options)
+        if args.output:
+            output.close()
+    else:
+        sequence1 = read_sequence(args.sequence1)
+        sequence2 = read_sequence(args.sequence2)
+        lines, score = align_pair(sequence1, sequence2, **options)
+
+        #print results
+        if lines is not None:
+            for line in lines:
+                print(line)
+        print(f'Alignment Score: {score}')
@@ -5,72 +5,353 @@ This script takes two genomic coordinate files in BED format and identifies whic
 overlap wihtin a specified percent overlap threshold. The out put is a set of overlapping genomic
 coordinates of the first file provided. However, the user can specify the --join option, whihc will return
 the overlapping coordinates from both files.
+The second file is loaded into an interval index of NumPy arrays per chromosome, and the elements
+of the first file are looked up in it in large batches with binary searches, instead of being
+compared with every element of the second.
+With --sorted, files sorted by chromosome and then start are read side by side in a single pass,
+so only the elements of the second file that can still overlap are held in memory.
+With --cache_dir, the index of the second file is saved as a binary file the first time and
+memory-mapped by later runs for as long as the file keeps its size and modification time.
+--threads spreads the chromosomes, and chunks of large ones, over a pool of worker processes and
+writes the overlaps in the same order as a single process would.
 '''
 
 import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from multiprocessing import Pool
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-i1', '--input_file1', metavar = "<Input file>", 
-    help = "First input file in BED format")
-parser.add_argument('-i2', '--input_file2', metavar = "<Input file>",
-    help = "Second input file in BED format")
-parser.add_argument('-m', '--minimum_overlap', metavar = "<Percentage>",
-    help = "Minimum percent overlap", type = int)
-parser.add_argument('-j', '--join', action = "store_true",
-    help = "Output first set and second set of overlaps side by side")
-parser.add_argument('-o', '--output', metavar = "<output_file_name>", 
-    help = "Name of output file")
-args = parser.parse_args()
-
-
-def calculate_overlap(chrom, start1, stop1, start2, stop2):
-    len = int(stop1) - int(start1)
-    overlap = (min(int(stop1), int(stop2))) - (max(int(start1), int(start2)))
-    if len > 0:
-        percent_overlap = (overlap/len)*100
-    if overlap > 0 and percent_overlap >= args.minimum_overlap:
-        with open(args.output, 'a') as output:
-            if args.join == True:
-                output.write(f"{chrom}\t{start1}\t{stop1}\t{chrom}\t{start2}\t{stop2}\n")
+import numpy as np
+
+#number of elements of the first file looked up at once, and handed to a worker process at a time
+#with --threads
+CHUNK = 1 << 15
+#powers of two, the bit length of a length is the number of them that are not larger than it
+POWERS = 1 << np.arange(63, dtype=np.int64)
+#number of overlaps --sorted collects before they are written
+BLOCK = 1 << 12
+#index cache files: magic, format version, size of the table of contents that follows
+CACHE_HEADER = struct.Struct('<4sIQ')
+CACHE_MAGIC = b'BEDX'
+CACHE_VERSION = 1
+
+#read the (chromosome, start, stop) records of a BED file one at a time
+#header, comment and empty lines are skipped
+def read_records(file):
+    with open(file, 'r') as bed_file:
+        for line in bed_file:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            yield fields[0], int(fields[1]), int(fields[2])
+
+#read a BED file into a dictionary of chromosome -> (starts, stops) integer arrays, in file order
+def read_bed(file):
+    intervals = {}
+    for chrom, start, stop in read_records(file):
+        if chrom not in intervals:
+            intervals[chrom] = ([], [])
+        intervals[chrom][0].append(start)
+        intervals[chrom][1].append(stop)
+    return {chrom: (np.array(starts, dtype=np.int64), np.array(stops, dtype=np.int64))
+        for chrom, (starts, stops) in intervals.items()}
+
+#pass records through, stopping with an error at the first one that is out of order
+def check_sorted(records, file):
+    previous = None
+    for record in records:
+        if previous is not None and record[:2] < previous[:2]:
+            raise ValueError(f"{file} is not sorted by chromosome and start (sort -k1,1 -k2,2n) at {record[0]}:{record[1]}")
+        previous = record
+        yield record
+
+#whether [start2, stop2) covers at least minimum_overlap percent of [start1, stop1)
+def enough_overlap(start1, stop1, start2, stop2, minimum_overlap):
+    overlap = min(stop1, stop2) - max(start1, start2)
+    return overlap > 0 and overlap*100 >= minimum_overlap*(stop1 - start1)
+
+#interval index of one chromosome
+#intervals are split into classes by the bit length of their length, so within a class no interval is
+#more than twice as long as another, and every class keeps its starts sorted next to the matching stops
+#an interval of a class can only overlap [start, stop) if it starts before stop and less than the
+#longest length of the class before start, which is a window found with two binary searches
+#the only intervals in that window that do not overlap are the ones ending shortly before start
+class IntervalIndex:
+    #index of every length class as a (longest length, starts, stops) triple
+    @classmethod
+    def from_classes(cls, classes):
+        index = cls.__new__(cls)
+        index.classes = classes
+        return index
+
+    def __init__(self, starts, stops):
+        #empty intervals cannot overlap anything
+        keep = stops > starts
+        starts = starts[keep]
+        stops = stops[keep]
+        length_classes = np.searchsorted(POWERS, stops - starts, side='right')
+        order = np.lexsort((stops, starts, length_classes))
+        starts = starts[order]
+        stops = stops[order]
+        length_classes = length_classes[order]
+        bounds = np.flatnonzero(np.diff(length_classes)) + 1
+        self.classes = []
+        for first, last in zip(np.r_[0, bounds], np.r_[bounds, len(starts)]):
+            if last > first:
+                longest = int((stops[first:last] - starts[first:last]).max())
+                self.classes.append((longest, starts[first:last], stops[first:last]))
+
+    #every overlap of the intervals [starts, stops) with the index, as arrays of the position of the
+    #query interval and the start and stop of the indexed one, sorted by all three
+    #the binary searches run over the query intervals in order of start, which is much faster
+    def query(self, starts, stops):
+        by_start = np.argsort(starts, kind='stable')
+        starts = starts[by_start]
+        stops = stops[by_start]
+        queries = [np.zeros(0, dtype=np.int64)]
+        starts2 = [np.zeros(0, dtype=np.int64)]
+        stops2 = [np.zeros(0, dtype=np.int64)]
+        for longest, class_starts, class_stops in self.classes:
+            first = np.searchsorted(class_starts, starts - longest, side='right')
+            last = np.searchsorted(class_starts, stops, side='left')
+            counts = np.maximum(last - first, 0)
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            #every window as a run of candidate positions, next to the query it belongs to
+            query = np.repeat(np.arange(len(starts)), counts)
+            candidates = np.arange(total) + np.repeat(first - (np.cumsum(counts) - counts), counts)
+            keep = class_stops[candidates] > starts[query]
+            queries.append(query[keep])
+            starts2.append(class_starts[candidates[keep]])
+            stops2.append(class_stops[candidates[keep]])
+        query = by_start[np.concatenate(queries)]
+        start2 = np.concatenate(starts2)
+        stop2 = np.concatenate(stops2)
+        order = np.lexsort((stop2, start2, query))
+        return query[order], start2[order], stop2[order]
+
+#path of the cached index of a BED file in cache_dir, named after the file's absolute path
+def cache_path(file, cache_dir):
+    name = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()
+    return os.path.join(cache_dir, f'{name}.bedx')
+
+#write the indexes of every chromosome to one file: a JSON table of contents with the source file's
+#path, size and mtime and the chromosome, longest length, offset and size of every length class,
+#followed by the starts and then the stops of all classes as int64 arrays
+#the file is written next to its final path and renamed, so readers never see half of it
+def write_index_cache(path, source, indexes):
+    classes = []
+    offset = 0
+    for chrom, index in indexes.items():
+        for longest, starts, stops in index.classes:
+            classes.append([chrom, longest, offset, len(starts)])
+            offset += len(starts)
+    table = json.dumps({'source': source, 'classes': classes}).encode()
+    #pad the table so the arrays start on an 8 byte boundary
+    table += b' '*(-(CACHE_HEADER.size + len(table)) % 8)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as cache:
+        cache.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(table)))
+        cache.write(table)
+        for column in (1, 2):
+            for index in indexes.values():
+                for length_class in index.classes:
+                    cache.write(np.ascontiguousarray(length_class[column], dtype=np.int64).tobytes())
+    os.replace(temporary, path)
+
+#memory-map the indexes written by write_index_cache, None when there is no usable cache file or it
+#was built from a different version of the source file
+def read_index_cache(path, source):
+    try:
+        with open(path, 'rb') as cache:
+            cache_map = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, table_size = CACHE_HEADER.unpack_from(cache_map, 0)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return None
+        table = json.loads(cache_map[CACHE_HEADER.size:CACHE_HEADER.size + table_size])
+    except (OSError, ValueError, struct.error):
+        return None
+    if table['source'] != source:
+        return None
+    total = sum(size for chrom, longest, offset, size in table['classes'])
+    start = CACHE_HEADER.size + table_size
+    starts = np.frombuffer(cache_map, dtype=np.int64, count=total, offset=start)
+    stops = np.frombuffer(cache_map, dtype=np.int64, count=total, offset=start + 8*total)
+    classes = {}
+    for chrom, longest, offset, size in table['classes']:
+        classes.setdefault(chrom, []).append((longest, starts[offset:offset + size], stops[offset:offset + size]))
+    return {chrom: IntervalIndex.from_classes(chrom_classes) for chrom, chrom_classes in classes.items()}
+
+#interval indexes of every chromosome of a BED file
+#with a cache_dir they are memory-mapped from a cache file kept up to date with the file's size and
+#mtime, and parsed and cached when it is missing or out of date
+def load_indexes(file, cache_dir=None):
+    if cache_dir is None:
+        return {chrom: IntervalIndex(starts, stops) for chrom, (starts, stops) in read_bed(file).items()}
+    status = os.stat(file)
+    source = [os.path.abspath(file), status.st_size, status.st_mtime_ns]
+    path = cache_path(file, cache_dir)
+    indexes = read_index_cache(path, source)
+    if indexes is None:
+        indexes = {chrom: IntervalIndex(starts, stops) for chrom, (starts, stops) in read_bed(file).items()}
+        os.makedirs(cache_dir, exist_ok=True)
+        write_index_cache(path, source, indexes)
+    return indexes
+
+#every overlap of an interval of the first file with one of the second that covers at least
+#minimum_overlap percent of the first, in blocks of (chromosome, starts1, stops1, starts2, stops2)
+#arrays, taking CHUNK elements of the first file at a time
+def find_overlaps(intervals1, indexes, minimum_overlap):
+    for chrom, (starts, stops) in intervals1.items():
+        index = indexes.get(chrom)
+        if index is None:
+            continue
+        for first in range(0, len(starts), CHUNK):
+            starts1 = starts[first:first + CHUNK]
+            stops1 = stops[first:first + CHUNK]
+            nonempty = np.flatnonzero(stops1 > starts1)
+            starts1 = starts1[nonempty]
+            stops1 = stops1[nonempty]
+            query, starts2, stops2 = index.query(starts1, stops1)
+            starts1 = starts1[query]
+            stops1 = stops1[query]
+            overlap = np.minimum(stops1, stops2) - np.maximum(starts1, starts2)
+            keep = overlap*100 >= minimum_overlap*(stops1 - starts1)
+            if keep.any():
+                yield chrom, starts1[keep], stops1[keep], starts2[keep], stops2[keep]
+
+#elements of the first file, indexes of the second and the overlap threshold, set once in every worker process
+shared = {}
+
+def init_worker(intervals1, indexes, minimum_overlap):
+    shared['intervals1'] = intervals1
+    shared['indexes'] = indexes
+    shared['minimum_overlap'] = minimum_overlap
+
+#overlaps of the elements numbered first to last-1 of one chromosome of the first file
+def chunk_overlaps(task):
+    chrom, first, last = task
+    starts, stops = shared['intervals1'][chrom]
+    part = {chrom: (starts[first:last], stops[first:last])}
+    return list(find_overlaps(part, shared['indexes'], shared['minimum_overlap']))
+
+#find_overlaps spread over a pool of worker processes, a chromosome at a time and in chunks of
+#CHUNK elements within large ones, with the overlaps coming back in the order find_overlaps gives
+def parallel_overlaps(intervals1, indexes, minimum_overlap, threads):
+    tasks = []
+    for chrom, (starts, stops) in intervals1.items():
+        if chrom in indexes:
+            for first in range(0, len(starts), CHUNK):
+                tasks.append((chrom, first, min(first + CHUNK, len(starts))))
+    with Pool(threads, initializer=init_worker, initargs=(intervals1, indexes, minimum_overlap)) as pool:
+        for overlaps in pool.imap(chunk_overlaps, tasks):
+            yield from overlaps
+
+#overlaps collected by sweep_overlaps as a block like the ones of find_overlaps
+def sweep_block(chrom, hits):
+    starts1, stops1, starts2, stops2 = (np.array(column, dtype=np.int64) for column in zip(*hits))
+    return chrom, starts1, stops1, starts2, stops2
+
+#the same overlaps as find_overlaps for two files sorted by chromosome, then start, found in a single
+#pass over both: the second file is read up to the stop of the current element of the first, and only
+#the elements of the second file that stop after the current start are kept, so memory depends on
+#how deeply the elements overlap and not on the size of the files
+def sweep_overlaps(file1, file2, minimum_overlap):
+    records2 = check_sorted(read_records(file2), file2)
+    pending = next(records2, None)
+    active = []
+    chrom = None
+    hits = []
+    for chrom1, start1, stop1 in check_sorted(read_records(file1), file1):
+        if chrom1 != chrom:
+            if hits:
+                yield sweep_block(chrom, hits)
+                hits = []
+            chrom = chrom1
+            active = []
+            while pending is not None and pending[0] < chrom:
+                pending = next(records2, None)
+        while pending is not None and pending[0] == chrom and pending[1] < stop1:
+            if pending[2] > pending[1]:
+                active.append(pending[1:])
+            pending = next(records2, None)
+        #elements of the first file start in order, so these cannot overlap any later one
+        active = [interval for interval in active if interval[1] > start1]
+        if stop1 <= start1:
+            continue
+        for start2, stop2 in sorted(interval for interval in active if interval[0] < stop1):
+            if enough_overlap(start1, stop1, start2, stop2, minimum_overlap):
+                hits.append((start1, stop1, start2, stop2))
+        if len(hits) >= BLOCK:
+            yield sweep_block(chrom, hits)
+            hits = []
+    if hits:
+        yield sweep_block(chrom, hits)
+
+#write blocks of overlaps to output, the elements of the first file or with --join both elements,
+#and echo the elements of the first file to standard output unless echo is False
+def write_overlaps(blocks, output, join, echo):
+    for chrom, starts1, stops1, starts2, stops2 in blocks:
+        starts1 = starts1.tolist()
+        stops1 = stops1.tolist()
+        lines = ''.join([f"{chrom}\t{start1}\t{stop1}\n" for start1, stop1 in zip(starts1, stops1)])
+        if output is not None:
+            if join:
+                output.write(''.join([f"{chrom}\t{start1}\t{stop1}\t{chrom}\t{start2}\t{stop2}\n"
+                    for start1, stop1, start2, stop2 in zip(starts1, stops1, starts2.tolist(), stops2.tolist())]))
             else:
-                output.write(f"{chrom}\t{start1}\t{stop1}\n")
-        print(f"{chrom}\t{start1}\t{stop1}")
-     
-dict1 = {}
-with open(args.input_file1, 'r') as file1:
-    for line in file1:
-        if line.split('\t')[0] not in dict1.keys():
-            dict1[line.split('\t')[0]] = []
-            dict1[line.split('\t')[0]].append([line.split('\t')[1], line.rstrip().split('\t')[2]])
-        else:
-            dict1[line.split('\t')[0]].append([line.split('\t')[1], line.rstrip().split('\t')[2]])
-file1.close()
-
-dict2 = {}
-with open(args.input_file2, 'r') as file2:
-    for line in file2:
-        if line.split('\t')[0] not in dict2.keys():
-            dict2[line.split('\t')[0]] = []
-            dict2[line.split('\t')[0]].append([line.split('\t')[1], line.rstrip().split('\t')[2]])
+                output.write(lines)
+        if echo:
+            sys.stdout.write(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i1', '--input_file1', metavar = "<Input file>", required = True,
+        help = "First input file in BED format")
+    parser.add_argument('-i2', '--input_file2', metavar = "<Input file>", required = True,
+        help = "Second input file in BED format")
+    parser.add_argument('-m', '--minimum_overlap', metavar = "<Percentage>", default = 0,
+        help = "Minimum percent overlap; default=0", type = int)
+    parser.add_argument('-j', '--join', action = "store_true",
+        help = "Output first set and second set of overlaps side by side")
+    parser.add_argument('-o', '--output', metavar = "<output_file_name>",
+        help = "Name of output file")
+    parser.add_argument('-s', '--sorted', action = "store_true",
+        help = "Both files are sorted by chromosome, then start (sort -k1,1 -k2,2n); stream them instead of loading them")
+    parser.add_argument('-t', '--threads', type = int, default = 1, metavar = "<Number of processes>",
+        help = "Number of worker processes, each taking a chromosome or a chunk of one at a time; default=1")
+    parser.add_argument('-c', '--cache_dir', metavar = "<Directory>",
+        help = "Keep a binary index of the second file here and reuse it while the file is unchanged")
+    parser.add_argument('-q', '--quiet', action = "store_true",
+        help = "Do not echo the overlapping elements of the first file to standard output")
+    args = parser.parse_args()
+    if args.threads > 1 and args.sorted:
+        parser.error("--threads cannot be combined with --sorted")
+    if args.cache_dir and args.sorted:
+        parser.error("--cache_dir cannot be combined with --sorted")
+    if args.quiet and not args.output:
+        parser.error("--quiet needs --output")
+
+    if args.sorted:
+        overlaps = sweep_overlaps(args.input_file1, args.input_file2, args.minimum_overlap)
+    else:
+        intervals1 = read_bed(args.input_file1)
+        indexes = load_indexes(args.input_file2, args.cache_dir)
+        if args.threads > 1:
+            overlaps = parallel_overlaps(intervals1, indexes, args.minimum_overlap, args.threads)
         else:
-            dict2[line.split('\t')[0]].append([line.split('\t')[1], line.rstrip().split('\t')[2]])
-file2.close()
-
-for key in dict1:
-    for i in range(len(dict1[key])):
-        try:
-            chrom = key
-            start1 = dict1[key][i][0]
-            stop1 = dict1[key][i][1]
-            start2 = dict2[key][0][0]
-            stop2 = dict2[key][0][1]
-            if stop2 < start1:
-                dict2[key] = dict2[key][1:]
-            if stop1 < start2:
-                continue
-            for j in range(len(dict2)):
-                start2 = dict2[key][j][0]
-                stop2 = dict2[key][j][1]
-                calculate_overlap(chrom, start1, stop1, start2, stop2)
-        except:
-            continue
\ No newline at end of file
+            overlaps = find_overlaps(intervals1, indexes, args.minimum_overlap)
+
+    output = open(args.output, 'a', buffering = 1 << 20) if args.output else None
+    try:
+        write_overlaps(overlaps, output, args.join, not args.quiet)
+    except ValueError as error:
+        parser.error(str(error))
+    finally:
+        if output is not None:
+            output.close()
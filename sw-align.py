@@ -1,172 +1,681 @@
 #!/usr/bin/env python3
 
 '''
-This script implements the Smith-Waterman alogrithm for sequence alignment. 
+This script implements the Smith-Waterman alogrithm for sequence alignment.
 This was more for practice than anything.
+--score-only reports the best local score alone from two rows of the matrix, filled with NumPy.
+--band only fills the cells within a given distance of the diagonal, which suits near-identical
+sequences, and doubles that distance while the best alignment runs along the edge of the band or
+could be beaten by one lying outside of it.
+--vectorized fills whole rows at once with NumPy from a query profile, and takes a substitution
+matrix (--matrix BLOSUM62 or an NCBI matrix file) and affine gap penalties (--gap-open for the
+first base of a gap, --gap-extend for every further one), any of which turns it on.
+--top-k reports several local alignments that share no aligned pair of bases (Waterman-Eggert),
+masking each one in the filled matrix and filling again only the cells after it.
+With --batch, both files may hold many sequences, every pair is aligned across a pool of worker
+processes and the scores, coordinates and identities are written as a table.
 '''
 
+import argparse
 import sys
+from multiprocessing import Pool
 
-seq1 = sys.argv[1]
-seq2 = sys.argv[2]
+import numpy as np
 
 gap = -2
 mis = -3
 match = 3
 
-#read each sequence file, store in separate lists
+#traceback direction codes of the banded matrix, STOP marks cells with a score of 0
+STOP = 0
+DIAGONAL = 1
+UP = 2
+LEFT = 3
+
+#score of cells outside of the band
+NEG = -(1 << 40)
 
 #open file, read second line
-seq1 = open(f'{seq1}', 'r')
-seq1 = seq1.readlines()
-seq = seq1[1].rstrip()
-
-#initialize list to store sequence and add every base to that list
-sequence1 = []
-for chr in seq:
-    sequence1.append(chr)
-
-#do the same as above for second sequence
-seq2 = open(f'{seq2}', 'r')
-seq2 = seq2.readlines()
-seq = seq2[1].rstrip()
-sequence2 = []
-for chr in seq:
-    sequence2.append(chr)
-
-#set up scoring matrix,
-#make first row in matrix and fill with gap penalties, 
-# fill start of every row with gap penalty
-matrix = []
-for i in range(len(sequence2)+1):
-    matrix.append([])
-for i in range(len(sequence1)+1):
-    matrix[0].append(gap*i)
-x = 1
-while x < len(matrix):
-    matrix[x].append(x*gap)
-    x+=1
-
-#set up traceback matrix same as before
-traceback = []
-for i in range(len(sequence2)+1):
-    traceback.append([])
-for i in range(len(sequence1)+1):
-    traceback[0].append(gap*i)
-x = 1
-while x < len(traceback):
-    traceback[x].append(x*gap)
-    x+=1
-
-#matrix filling
-for i in range(len(sequence2)):
-    for j in range(len(sequence1)):
-        diagonal = matrix[i][j]
-        left = matrix[i+1][j] + gap
-        up = matrix[i][j+1] + gap
-        #compare adjacent values
-        #see if diagonal is hit or miss
-        if sequence2[i] == sequence1[j]:
-            diagonal = diagonal + match
-        elif sequence2[i] != sequence1[j]:
-            diagonal = diagonal + mis
-        #check diagonal, compare scores, add highest to matrix
-        if diagonal >= up and diagonal >= left and diagonal >= 0:
-            matrix[i+1].append(diagonal)
-            traceback[i+1].append('d')
-        #if value is less than 0, add 0
-        elif diagonal >= up and diagonal >= left and diagonal < 0:
-            matrix[i+1].append(0)
-            traceback[i+1].append('d')
-        #check up, if value is greater than or equal to 0, add value, else add 0
-        elif up >= left and up > diagonal and up >= 0:
-            matrix[i+1].append(up)
-            traceback[i+1].append('u')
-        elif up >= left and up > diagonal and up < 0:
-            matrix[i+1].append(0)
-            traceback[i+1].append('u')
-        #check left, if value is greater than or equal to 0, add value, else add 0
-        elif left > up and left >=0:
-            matrix[i+1].append(left)
-            traceback[i+1].append('l')
-        elif left > up and left < 0:
-            matrix[i+1].append(0)
-            traceback[i+1].append('l')
+def read_sequence(file):
+    with open(file, 'r') as seq_file:
+        return seq_file.readlines()[1].rstrip()
 
-#backtracking
-#get length of longest sequence for iteration number
-if len(sequence1) > len(sequence2):
-    length = len(sequence1)
-elif len(sequence2) > len(sequence1):
-    length = len(sequence2)
-
-#define lists that will hold alignment information
-line1 = []
-line2 = []
-line3 = []
-
-#loop through traceback matrix and find path of best alignment, 
-#add bases and gap/mismatch information to lists
-
-#find coordinates of greatest value = start position 
-best = 0
-for list in matrix:
-    for value in list:
-        if value > best:
+#set up scoring matrix and traceback matrix,
+#a local alignment can start anywhere, so the first row and column are all 0
+def fill(sequence1, sequence2):
+    matrix = []
+    traceback = []
+    for i in range(len(sequence2)+1):
+        matrix.append([0])
+        traceback.append(['d'])
+    for i in range(len(sequence1)):
+        matrix[0].append(0)
+        traceback[0].append('d')
+
+    #matrix filling
+    #the highest cell of every row is kept while filling, as (score, first column holding it)
+    best_cells = [(0, 0)]
+    for i in range(len(sequence2)):
+        row_best = 0
+        row_column = 0
+        for j in range(len(sequence1)):
+            diagonal = matrix[i][j]
+            left = matrix[i+1][j] + gap
+            up = matrix[i][j+1] + gap
+            #compare adjacent values
+            #see if diagonal is hit or miss
+            if sequence2[i] == sequence1[j]:
+                diagonal = diagonal + match
+            else:
+                diagonal = diagonal + mis
+            #check diagonal, then up, then left, add highest to matrix, or 0 if it is negative
+            if diagonal >= up and diagonal >= left:
+                value = diagonal
+                traceback[i+1].append('d')
+            elif up >= left:
+                value = up
+                traceback[i+1].append('u')
+            else:
+                value = left
+                traceback[i+1].append('l')
+            if value < 0:
+                value = 0
+            matrix[i+1].append(value)
+            if value > row_best:
+                row_best = value
+                row_column = j+1
+        best_cells.append((row_best, row_column))
+    return matrix, traceback, best_cells
+
+#find coordinates of greatest value = end position
+#the last row holding it and its first column in that row
+def find_best(best_cells):
+    best = 0
+    row = 0
+    column = 0
+    for index, (value, value_column) in enumerate(best_cells):
+        if value >= best:
             best = value
+            row = index
+            column = value_column
+    return row, column
+
+#one cell of fill, with the same tie-breaking, for cells that are filled again in masking
+def score_cell(matrix, sequence1, sequence2, i, j):
+    diagonal = matrix[i-1][j-1] + (match if sequence2[i-1] == sequence1[j-1] else mis)
+    left = matrix[i][j-1] + gap
+    up = matrix[i-1][j] + gap
+    if diagonal >= up and diagonal >= left:
+        return max(diagonal, 0), 'd'
+    if up >= left:
+        return max(up, 0), 'u'
+    return max(left, 0), 'l'
+
+#backtracking
+#loop through traceback matrix from the best cell until a score of 0 and find path of best alignment,
+#add bases and gap/mismatch information to lists, and the cells visited to path if one is given
+def trace(matrix, traceback, sequence1, sequence2, row, column, path=None):
+    line1 = []
+    line2 = []
+    line3 = []
+    x = row
+    y = column
+    while matrix[x][y] != 0:
+        if path is not None:
+            path.append((x, y))
+        target = traceback[x][y]
+        if target == 'd':
+            line1.append(sequence1[y-1])
+            if sequence1[y-1] == sequence2[x-1]:
+                line2.append('|')
+            else:
+                line2.append('*')
+            line3.append(sequence2[x-1])
+            x -= 1
+            y -= 1
+        elif target == 'l':
+            line1.append(sequence1[y-1])
+            line2.append(' ')
+            line3.append('-')
+            y -= 1
+        elif target == 'u':
+            line1.append('-')
+            line2.append(' ')
+            line3.append(sequence2[x-1])
+            x -= 1
+    return ''.join(line1[::-1]), ''.join(line2[::-1]), ''.join(line3[::-1])
+
+#Waterman-Eggert masking: the cells of an alignment that was reported are set to 0 for good, and
+#the cells after them are filled again, row by row, only as far as their scores change
+#the highest cell of every row that changed is found again
+def mask_path(matrix, traceback, best_cells, sequence1, sequence2, path, masked):
+    masked.update(path)
+    path_columns = {}
+    for x, y in path:
+        low, high = path_columns.get(x, (y, y))
+        path_columns[x] = (min(low, y), max(high, y))
+    i = min(path_columns)
+    #columns of the previous row whose scores changed
+    changed = None
+    while i < len(matrix):
+        spans = [span for span in (path_columns.get(i), changed) if span is not None]
+        if not spans:
+            break
+        start = max(min(low for low, high in spans), 1)
+        stop = max(high for low, high in spans) + 1
+        row_changed = None
+        carry = False
+        j = start
+        while j < len(matrix[i]) and (j <= stop or carry):
+            if (i, j) in masked:
+                value, direction = 0, 'd'
+            else:
+                value, direction = score_cell(matrix, sequence1, sequence2, i, j)
+            traceback[i][j] = direction
+            carry = value != matrix[i][j]
+            if carry:
+                matrix[i][j] = value
+                row_changed = (j, j) if row_changed is None else (row_changed[0], j)
+            j += 1
+        if row_changed is not None or i in path_columns:
+            row_best = max(matrix[i])
+            best_cells[i] = (row_best, matrix[i].index(row_best) if row_best > 0 else 0)
+        changed = row_changed
+        i += 1
 
-for list in matrix:
-    if best in list:
-        row = matrix.index(list)
-        column = list.index(best)
-
-#convert to reverse index to iterate backwards
-row = row - len(matrix)
-column = column - len(matrix[0])
-
-
-x=row
-y=column
-for i in range(length):
-    target = traceback[x][y]
-    value = matrix[x][y]
-    if value == 0:
-        break
-    if target == 'd':
-        line1.append(sequence1[y])
-        if sequence1[y] == sequence2[x]:
-            line2.append('|')
+#up to k local alignments that share no aligned cell, best first, as (lines, score, end) like align_pair
+def top_alignments(sequence1, sequence2, k):
+    matrix, traceback, best_cells = fill(sequence1, sequence2)
+    masked = set()
+    hits = []
+    while len(hits) < k:
+        row, column = find_best(best_cells)
+        score = matrix[row][column]
+        #a pair with no positive score still gets its single empty alignment
+        if score == 0 and hits:
+            break
+        path = []
+        lines = trace(matrix, traceback, sequence1, sequence2, row, column, path)
+        hits.append((lines, score, (column, row)))
+        if score == 0:
+            break
+        mask_path(matrix, traceback, best_cells, sequence1, sequence2, path, masked)
+    return hits
+
+#score of every base of sequence1 against each distinct base of sequence2
+def substitution_rows(sequence1, sequence2):
+    codes1 = np.frombuffer(sequence1.encode(), dtype=np.uint8)
+    rows = {}
+    for base in set(sequence2):
+        rows[base] = np.where(codes1 == ord(base), match, mis).astype(np.int64)
+    return rows
+
+#best local score, keeping only two rows of the matrix
+#diagonal and up moves only depend on the previous row, and the chain of left moves is a running
+#maximum, H[j] = gap*j + max over k <= j of (best[k] - gap*k), which never drops below 0 because
+#every best[k] is at least 0
+def best_score(sequence1, sequence2):
+    rows = substitution_rows(sequence1, sequence2)
+    steps = gap*np.arange(len(sequence1)+1, dtype=np.int64)
+    previous = np.zeros(len(sequence1)+1, dtype=np.int64)
+    best = np.zeros(len(sequence1)+1, dtype=np.int64)
+    score = 0
+    for base in sequence2:
+        np.maximum(previous[:-1] + rows[base], previous[1:] + gap, out=best[1:])
+        np.maximum(best, 0, out=best)
+        previous = np.maximum.accumulate(best - steps) + steps
+        score = max(score, int(previous.max()))
+    return score
+
+#banded matrix filling, only cells (i, j) with low <= j - i <= high are computed
+#row i of the band holds cells j = i + low + k for k in 0..width-1, so the diagonal move stays in
+#column k, the up move comes from column k+1 of the previous row and the left move from column k-1
+#the best cell is the last row holding the highest score, and its first column in that row
+def banded_fill(sequence1, sequence2, low, high):
+    n = len(sequence2)
+    m = len(sequence1)
+    width = high - low + 1
+    #pad sequence1 with a zero byte so cells outside of the matrix can be looked up too
+    codes1 = np.frombuffer(sequence1.encode() + b'\0', dtype=np.uint8)
+    ks = np.arange(width, dtype=np.int64)
+    steps = gap*ks
+    traceback = np.zeros((n+1, width), dtype=np.uint8)
+    j = low + ks
+    previous = np.where((j >= 0) & (j <= m), 0, NEG)
+    score = 0
+    row = 0
+    column = 0
+    for i in range(1, n+1):
+        j = i + low + ks
+        valid = (j >= 0) & (j <= m)
+        scores = np.where(codes1[np.clip(j-1, 0, m)] == ord(sequence2[i-1]), match, mis)
+        diagonal = np.where(j >= 1, previous + scores, NEG)
+        up = np.full(width, NEG, dtype=np.int64)
+        up[:-1] = previous[1:] + gap
+        best = np.where(valid, np.maximum(np.maximum(diagonal, up), 0), NEG)
+        current = np.where(valid, np.maximum.accumulate(best - steps) + steps, NEG)
+        left = np.empty(width, dtype=np.int64)
+        left[0] = NEG
+        left[1:] = current[:-1] + gap
+        traceback[i] = np.where(current <= 0, STOP,
+            np.where((diagonal >= up) & (diagonal >= left), DIAGONAL, np.where(up >= left, UP, LEFT)))
+        k = int(np.argmax(current))
+        if current[k] >= score:
+            score = int(current[k])
+            row = i
+            column = i + low + k
+        previous = current
+    return traceback, score, row, column
+
+#backtracking through a banded traceback matrix, indexed by (i, j - i - low)
+#also reports whether the path ran along an edge of the band that cuts through the matrix
+def trace_band(traceback, sequence1, sequence2, row, column, low, high):
+    line1 = []
+    line2 = []
+    line3 = []
+    width = high - low + 1
+    edge = False
+    x = row
+    y = column
+    while True:
+        k = y - x - low
+        target = traceback[x, k]
+        if target == STOP:
+            break
+        if (k == 0 and low > -len(sequence2)) or (k == width-1 and high < len(sequence1)):
+            edge = True
+        if target == DIAGONAL:
+            line1.append(sequence1[y-1])
+            if sequence1[y-1] == sequence2[x-1]:
+                line2.append('|')
+            else:
+                line2.append('*')
+            line3.append(sequence2[x-1])
+            x -= 1
+            y -= 1
+        elif target == LEFT:
+            line1.append(sequence1[y-1])
+            line2.append(' ')
+            line3.append('-')
+            y -= 1
         else:
-            line2.append('*')
-        line3.append(sequence2[x])
-        x-=1
-        y-=1
-    elif target == 'l':
-        line1.append(sequence1[y])
-        line2.append(' ')
-        line3.append('-')
-        x = x
-        y -= 1
-    elif target == 'u':
-        line1.append('-')
-        line2.append(' ')
-        line3.append(sequence2[x])
-        x -= 1
-        y = y
-
-
-#print results
-str = ""
-print(str.join(line1[::-1]))
-print(str.join(line2[::-1]))
-print(str.join(line3[::-1]))
-print(f'Alignment Score: {matrix[row][column]}')
+            line1.append('-')
+            line2.append(' ')
+            line3.append(sequence2[x-1])
+            x -= 1
+    return (''.join(line1[::-1]), ''.join(line2[::-1]), ''.join(line3[::-1])), edge
 
+#banded local alignment around the main diagonal
+#a best alignment that runs along the edge of the band may have been cut short by it, and one that
+#lies wholly outside of the band can score at most match times the longest diagonal out there,
+#so the band is doubled until neither can beat the banded score or the band covers the whole matrix
+def align_banded(sequence1, sequence2, w):
+    n = len(sequence2)
+    m = len(sequence1)
+    while True:
+        low = max(min(0, m-n) - w, -n)
+        high = min(max(0, m-n) + w, m)
+        traceback, score, row, column = banded_fill(sequence1, sequence2, low, high)
+        lines, edge = trace_band(traceback, sequence1, sequence2, row, column, low, high)
+        outside = match*max(min(n, m-high-1), min(m, n+low-1), 0)
+        if (not edge and score >= outside) or (low == -n and high == m):
+            return lines, score, row, column
+        w = max(2*w, 1)
+
+#BLOSUM62 substitution matrix, other matrices (PAM250, BLOSUM45, ...) can be read from NCBI matrix files
+BLOSUM62 = '''
+   A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  B  Z  X  *
+A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+R -1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+N -2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+D -2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+C  0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+Q -1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+E -1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+G  0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+H -2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+I -1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+L -1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+K -1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+M -1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+F -2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+P -1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+S  1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+T  0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+W -3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+Y -2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+V  0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+B -2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+Z -1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+X  0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+* -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
 '''
-for i in range(len(matrix)):
-    print(matrix[i])
 
-for i in range(len(traceback)):
-    print(traceback[i])
+#substitution scores of the match/mis constants as a 256 x 256 table indexed by byte
+def linear_table():
+    table = np.full((256, 256), mis, dtype=np.int64)
+    np.fill_diagonal(table, match)
+    return table
+
+#read a substitution matrix in NCBI format, by name for BLOSUM62 or from a file
+#letters missing from the matrix score as its lowest entry, lowercase letters as uppercase ones
+def read_matrix(name):
+    if name.upper() == 'BLOSUM62':
+        text = BLOSUM62
+    else:
+        with open(name, 'r') as matrix_file:
+            text = matrix_file.read()
+    rows = [line.split() for line in text.splitlines() if line.strip() and not line.startswith('#')]
+    letters = rows[0]
+    scores = {}
+    for row in rows[1:]:
+        for letter, value in zip(letters, row[1:]):
+            scores[(row[0], letter)] = int(value)
+    table = np.full((256, 256), min(scores.values()), dtype=np.int64)
+    for (a, b), value in scores.items():
+        for x in {a, a.lower()}:
+            for y in {b, b.lower()}:
+                table[ord(x), ord(y)] = value
+    return table
+
+#query profile: for every letter of the target, the score of each query position
+def query_profile(table, query, target):
+    codes = np.frombuffer(query.encode(), dtype=np.uint8)
+    profile = {}
+    for letter in set(target):
+        profile[letter] = table[ord(letter), codes]
+    return profile
+
+#Smith-Waterman with a query profile and affine gaps, one target letter (row) at a time
+#the diagonal and up (E) moves of a whole row are computed at once from the previous row, and the
+#left (F) moves are a single running maximum, F[j] = max over k < j of (H[k] - go - (j-1-k)*ge), where
+#H may leave out F because closing a gap and opening the next one is never better than extending it
+#gaps cost gap_open for their first base and gap_extend for every further one
+#local keeps scores at 0 or above and returns the best score and its cell: the last row holding it
+#and its first column in that row; otherwise the alignment is anchored at the first cell and the
+#furthest row and column of any cell that reaches the score `reach` are returned
+def profile_fill(query, target, table, gap_open, gap_extend, local=True, reach=None):
+    go = -gap_open
+    ge = -gap_extend
+    m = len(query)
+    profile = query_profile(table, query, target)
+    steps = ge*np.arange(m+1, dtype=np.int64)
+    h_previous = np.zeros(m+1, dtype=np.int64)
+    if not local:
+        h_previous[1:] = -go - steps[:-1]
+    e_previous = np.full(m+1, NEG, dtype=np.int64)
+    f = np.full(m+1, NEG, dtype=np.int64)
+    best = 0
+    row = 0
+    column = 0
+    for i in range(1, len(target)+1):
+        e = np.maximum(h_previous - go, e_previous - ge)
+        h = np.empty(m+1, dtype=np.int64)
+        h[0] = 0 if local else -go - (i-1)*ge
+        np.maximum(h_previous[:-1] + profile[target[i-1]], e[1:], out=h[1:])
+        if local:
+            np.maximum(h, 0, out=h)
+        f[1:] = np.maximum.accumulate(h + steps)[:-1] - go - steps[:-1]
+        np.maximum(h, f, out=h)
+        h_previous = h
+        e_previous = e
+        if not local:
+            hits = np.nonzero(h[1:] == reach)[0]
+            if len(hits):
+                row = i
+                column = max(column, int(hits[-1]) + 1)
+            continue
+        j = int(np.argmax(h))
+        if h[j] >= best:
+            best = int(h[j])
+            row = i
+            #column 0 always holds a 0
+            column = j
+    return best, row, column
+
+#local alignment with affine gaps over a whole (small) matrix, traced back from its last cell
+#the last cell is where the best alignment found by the forward scan ends, and the matrix starts
+#where the reverse scan found it begins
+def box_trace(query, target, table, gap_open, gap_extend):
+    go = -gap_open
+    ge = -gap_extend
+    n = len(target)
+    m = len(query)
+    codes = np.frombuffer(query.encode(), dtype=np.uint8)
+    steps = ge*np.arange(m+1, dtype=np.int64)
+    choice = np.zeros((n+1, m+1), dtype=np.uint8)
+    e_extend = np.zeros((n+1, m+1), dtype=bool)
+    f_extend = np.zeros((n+1, m+1), dtype=bool)
+    h_previous = np.zeros(m+1, dtype=np.int64)
+    e_previous = np.full(m+1, NEG, dtype=np.int64)
+    for i in range(1, n+1):
+        diagonal = h_previous[:-1] + table[ord(target[i-1]), codes]
+        e = np.maximum(h_previous - go, e_previous - ge)
+        e_extend[i] = e_previous - ge > h_previous - go
+        h = np.zeros(m+1, dtype=np.int64)
+        h[1:] = np.maximum(np.maximum(diagonal, e[1:]), 0)
+        #F[j] = max over k < j of (H[k] - go - (j-1-k)*ge), H without F is enough because
+        #closing a gap and opening the next one is never better than extending it
+        f = np.full(m+1, NEG, dtype=np.int64)
+        f[1:] = np.maximum.accumulate(h + steps)[:-1] - go - steps[:-1]
+        np.maximum(h, f, out=h)
+        f_extend[i, 2:] = f[1:-1] - ge > h[1:-1] - go
+        choice[i, 1:] = np.where(h[1:] <= 0, STOP, np.where((diagonal >= e[1:]) & (diagonal >= f[1:]),
+            DIAGONAL, np.where(e[1:] >= f[1:], UP, LEFT)))
+        h_previous = h
+        e_previous = e
+    line1 = []
+    line2 = []
+    line3 = []
+    x = n
+    y = m
+    state = DIAGONAL
+    while x > 0 and y >= 0:
+        if state == DIAGONAL:
+            target_choice = choice[x, y]
+            if target_choice == STOP:
+                break
+            if target_choice == DIAGONAL:
+                line1.append(query[y-1])
+                line2.append('|' if query[y-1] == target[x-1] else '*')
+                line3.append(target[x-1])
+                x -= 1
+                y -= 1
+                continue
+            state = target_choice
+        if state == UP:
+            line1.append('-')
+            line2.append(' ')
+            line3.append(target[x-1])
+            state = UP if e_extend[x, y] else DIAGONAL
+            x -= 1
+        else:
+            line1.append(query[y-1])
+            line2.append(' ')
+            line3.append('-')
+            state = LEFT if f_extend[x, y] else DIAGONAL
+            y -= 1
+    return ''.join(line1[::-1]), ''.join(line2[::-1]), ''.join(line3[::-1])
+
+#local alignment from two scans that keep a single row: a forward scan finds the best score and where
+#it ends, a scan of both reversed prefixes anchored at that end finds the earliest row and column any
+#alignment with that score can start from, and only the cells in between are filled again to trace
+#the alignment, which then takes the same path through them as a traceback of the full matrix would
+def align_profile(sequence1, sequence2, table, gap_open, gap_extend, score_only=False):
+    score, row, column = profile_fill(sequence1, sequence2, table, gap_open, gap_extend)
+    if score_only or score == 0:
+        return ('', '', ''), score, row, column
+    rows, columns = profile_fill(sequence1[:column][::-1], sequence2[:row][::-1], table,
+        gap_open, gap_extend, local=False, reach=score)[1:]
+    lines = box_trace(sequence1[column-columns:column], sequence2[row-rows:row], table, gap_open, gap_extend)
+    return lines, score, row, column
+
+#align two sequences with the chosen mode
+#returns the three lines, the score and the last aligned position in each sequence,
+#the lines and positions are None when only the score is wanted
+def align_pair(sequence1, sequence2, band=None, score_only=False, scoring=None):
+    if scoring is not None:
+        lines, score, row, column = align_profile(sequence1, sequence2, *scoring, score_only=score_only)
+    elif band is not None:
+        lines, score, row, column = align_banded(sequence1, sequence2, band)
+    elif score_only:
+        return None, best_score(sequence1, sequence2), None
+    else:
+        matrix, traceback, best_cells = fill(sequence1, sequence2)
+        row, column = find_best(best_cells)
+        lines = trace(matrix, traceback, sequence1, sequence2, row, column)
+        score = matrix[row][column]
+    if score_only:
+        return None, score, None
+    return lines, score, (column, row)
+
+#read every record of a multi-FASTA file as (name, sequence) pairs
+def read_fasta(file):
+    records = []
+    name = None
+    parts = []
+    with open(file, 'r') as seq_file:
+        for line in seq_file:
+            line = line.rstrip()
+            if line.startswith('>'):
+                if name is not None:
+                    records.append((name, ''.join(parts)))
+                name = line[1:].split()[0] if line[1:].split() else ''
+                parts = []
+            elif line:
+                parts.append(line)
+    if name is not None:
+        records.append((name, ''.join(parts)))
+    return records
+
+#sequences and alignment options of a batch run, set once in every worker process
+batch = {}
+
+def init_batch(queries, targets, options):
+    batch['queries'] = queries
+    batch['targets'] = targets
+    batch['options'] = options
+
+#align the query/target pairs numbered start to stop-1 and return their TSV lines
+def batch_rows(bounds):
+    start, stop = bounds
+    queries = batch['queries']
+    targets = batch['targets']
+    rows = []
+    for index in range(start, stop):
+        query_name, query = queries[index // len(targets)]
+        target_name, target = targets[index % len(targets)]
+        for row in pair_rows(query, target, batch['options']):
+            rows.append(f"{query_name}\t{target_name}\t{row}\n")
+    return ''.join(rows)
+
+#align every query against every target, handing chunks of pairs to a pool of worker processes,
+#and stream the results to output in a fixed order
+def run_batch(query_file, target_file, output, threads, chunk_size, options):
+    queries = read_fasta(query_file)
+    targets = read_fasta(target_file)
+    total = len(queries)*len(targets)
+    chunks = [(start, min(start + chunk_size, total)) for start in range(0, total, chunk_size)]
+    output.write('query\ttarget\tscore\tquery_start\tquery_end\ttarget_start\ttarget_end\tidentity\n')
+    if threads <= 1:
+        init_batch(queries, targets, options)
+        for chunk in chunks:
+            output.write(batch_rows(chunk))
+        return
+    with Pool(threads, initializer=init_batch, initargs=(queries, targets, options)) as pool:
+        for rows in pool.imap(batch_rows, chunks):
+            output.write(rows)
+
+#percent of alignment columns that are matches
+def identity(lines):
+    if not lines[1]:
+        return 0.0
+    return 100*lines[1].count('|')/len(lines[1])
+
+#score, 1-based coordinates and identity of the best local alignment, or of each of the top k
+def pair_rows(query, target, options):
+    options = dict(options)
+    top_k = options.pop('top_k')
+    if top_k > 1:
+        hits = top_alignments(query, target, top_k)
+    else:
+        hits = [align_pair(query, target, **options)]
+    rows = []
+    for lines, score, end in hits:
+        if lines is None:
+            rows.append(f"{score}\tNA\tNA\tNA\tNA\tNA")
+            continue
+        query_end, target_end = end
+        query_start = query_end - len(lines[0].replace('-', '')) + 1
+        target_start = target_end - len(lines[2].replace('-', '')) + 1
+        rows.append(f"{score}\t{query_start}\t{query_end}\t{target_start}\t{target_end}\t{identity(lines):.2f}")
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sequence1', help = "FASTA file with the first sequence on its second line, or the queries with --batch")
+    parser.add_argument('sequence2', help = "FASTA file with the second sequence on its second line, or the targets with --batch")
+    parser.add_argument('--band', type = int, metavar = "<Width>",
+        help = "Only fill cells within this distance of the diagonal, widened while the alignment touches its edge")
+    parser.add_argument('--score-only', action = "store_true",
+        help = "Only report the alignment score")
+    parser.add_argument('--vectorized', action = "store_true",
+        help = "Fill whole rows at once from a query profile, implied by --matrix, --gap-open and --gap-extend")
+    parser.add_argument('--matrix', metavar = "<Matrix>",
+        help = "BLOSUM62 or an NCBI format substitution matrix file; default=match/mismatch of 3/-3")
+    parser.add_argument('--gap-open', type = int, default = gap, metavar = "<Score>",
+        help = f"Score of the first base of a gap; default={gap}")
+    parser.add_argument('--gap-extend', type = int, default = gap, metavar = "<Score>",
+        help = f"Score of every further base of a gap; default={gap}")
+    parser.add_argument('--top-k', type = int, default = 1, metavar = "<Number>",
+        help = "Report up to this many local alignments that share no aligned pair of bases, best first; default=1")
+    parser.add_argument('--batch', action = "store_true",
+        help = "Treat both files as multi-FASTA and align every sequence of the first against every sequence of the second")
+    parser.add_argument('-o', '--output', metavar = "<output_file_name>",
+        help = "TSV file for --batch results; default=standard output")
+    parser.add_argument('-t', '--threads', type = int, default = 1, metavar = "<Number of processes>",
+        help = "Number of worker processes for --batch; default=1")
+    parser.add_argument('--chunk-size', type = int, default = 64, metavar = "<Pairs>",
+        help = "Number of pairs handed to a worker at a time in --batch; default=64")
+    args = parser.parse_args()
+    if args.band is not None and args.band < 0:
+        parser.error("--band must be at least 0")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    scoring = None
+    if args.vectorized or args.matrix or args.gap_open != gap or args.gap_extend != gap:
+        if args.band is not None:
+            parser.error("--band only works with the match/mismatch and linear gap scores")
+        if not args.gap_open <= args.gap_extend <= 0:
+            parser.error("gap scores must satisfy --gap-open <= --gap-extend <= 0")
+        table = read_matrix(args.matrix) if args.matrix else linear_table()
+        scoring = (table, args.gap_open, args.gap_extend)
+    if args.top_k < 1:
+        parser.error("--top-k must be at least 1")
+    if args.top_k > 1 and (args.band is not None or args.score_only or scoring is not None):
+        parser.error("--top-k cannot be combined with --band, --score-only or other scores")
+    options = {'band': args.band, 'score_only': args.score_only, 'scoring': scoring, 'top_k': args.top_k}
+
+    if args.batch:
+        output = open(args.output, 'w') if args.output else sys.stdout
+        run_batch(args.sequence1, args.sequence2, output, args.threads, args.chunk_size, options)
+        if args.output:
+            output.close()
+    else:
+        sequence1 = read_sequence(args.sequence1)
+        sequence2 = read_sequence(args.sequence2)
+        if args.top_k > 1:
+            hits = top_alignments(sequence1, sequence2, args.top_k)
+        else:
+            lines, score, end = align_pair(sequence1, sequence2, band=args.band,
+                score_only=args.score_only, scoring=scoring)
+            hits = [(lines, score, end)]
 
-'''
\ No newline at end of file
+        #print results
+        for number, (lines, score, end) in enumerate(hits):
+            if number:
+                print()
+            if lines is not None:
+                for line in lines:
+                    print(line)
+            print(f'Alignment Score: {score}')